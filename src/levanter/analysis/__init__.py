@@ -1,14 +1,23 @@
 __all__ = [
     "cb_compute_entropies",
     "cb_compute_top2_gap",
+    "compute_entropy_and_top2_gap_histograms",
     "compute_entropy_histogram",
     "compute_top2_gap_histogram",
+    "entropy_and_top2_gap_from_embeddings",
     "summary_statistics_for_tree",
     "cb_compute_and_visualize_log_probs",
     "visualize_log_prob_diff",
     "visualize_log_probs",
 ]
 
-from .entropy import cb_compute_entropies, cb_compute_top2_gap, compute_entropy_histogram, compute_top2_gap_histogram
+from .entropy import (
+    cb_compute_entropies,
+    cb_compute_top2_gap,
+    compute_entropy_and_top2_gap_histograms,
+    compute_entropy_histogram,
+    compute_top2_gap_histogram,
+    entropy_and_top2_gap_from_embeddings,
+)
 from .tree_stats import summary_statistics_for_tree
 from .visualization import cb_compute_and_visualize_log_probs, visualize_log_prob_diff, visualize_log_probs
@@ -1,7 +1,8 @@
 """Functions for computing and visualizing token-level entropy."""
 
+import functools
 import logging
-from typing import Callable, TypeVar
+from typing import Callable, Optional, TypeVar
 
 import equinox as eqx
 import jax
@@ -9,7 +10,6 @@ import jax.numpy as jnp
 from jaxtyping import PyTree
 
 import haliax as hax
-import haliax.nn as hnn
 from haliax.jax_utils import named_call
 
 import levanter.tracker
@@ -29,9 +29,12 @@ def entropy_from_logits(logits: hax.NamedArray, axis: hax.AxisSelector) -> hax.N
     """
     Computes entropy over the given axis in a numerically stable way using raw logits.
     """
-    log_z = hnn.logsumexp(logits, axis=axis)
-    probs = hax.exp(logits - log_z)
-    entropy = log_z - hax.sum(probs * logits, axis=axis)
+    # H = log Z - sum(exp(s) * s) / Z with s = logits - max and Z = sum(exp(s)). Both sums read the same exp(s), so
+    # XLA can do them in a single pass over the vocab, and the normalized probabilities are never materialized.
+    shifted = logits - hax.max(logits, axis=axis)
+    exp_shifted = hax.exp(shifted)
+    z = hax.sum(exp_shifted, axis=axis)
+    entropy = hax.log(z) - hax.sum(exp_shifted * shifted, axis=axis) / z
     return entropy
 
 
@@ -53,9 +56,12 @@ def top2_gap_from_logits(logits: hax.NamedArray, axis: hax.AxisSelector) -> hax.
     # top1 = sorted_logits["top", 0]
     # top2 = sorted_logits["top", 1]
 
+    axis = logits.resolve_axis(axis)
     argmax = hax.argmax(logits, axis=axis)
     top1 = hax.take(logits, axis, argmax)
-    argmax2 = hax.argmax(hax.where(argmax, -jnp.inf, logits), axis=axis)
+    # mask out the top-1 entry (and only it) to find the runner-up
+    is_top1 = hax.nn.one_hot(argmax, axis, dtype=jnp.bool_)
+    argmax2 = hax.argmax(hax.where(is_top1, -jnp.inf, logits), axis=axis)
     top2 = hax.take(logits, axis, argmax2)
     return top1 - top2
 
@@ -184,6 +190,188 @@ def _compute_top2_gap_on_device(logit_fn, model, batch: B, Vocab) -> jnp.ndarray
     return gaps.flatten("token").array
 
 
+@named_call
+def entropy_and_top2_gap_from_embeddings(
+    embeddings: hax.NamedArray,
+    lm_head: hax.NamedArray,
+    Contract: hax.AxisSelector,
+    Label: hax.AxisSelector,
+    block_size: Optional[int] = None,
+) -> tuple[hax.NamedArray, hax.NamedArray]:
+    """
+    Computes the entropy and the top-2 gap of the logits `embeddings @ lm_head`, as [entropy_from_logits][] and
+    [top2_gap_from_logits][] would.
+
+    If `block_size` is given, the logits are computed `block_size` vocab entries at a time and folded into running
+    statistics (with the same online rescaling as the blockwise cross-entropy loss), so the full [..., Vocab] logits
+    are never materialized.
+
+    Args:
+        embeddings: The final hidden states, e.g. [Batch, Pos, Embed].
+        lm_head: The language modeling head, e.g. [Embed, Vocab].
+        Contract: The axis to contract over (e.g. Embed).
+        Label: The vocabulary axis.
+        block_size: Number of vocabulary entries per block, or None to materialize the full logits.
+
+    Returns:
+        tuple[NamedArray, NamedArray]: The entropies and the top-2 gaps, with the axes of `embeddings` minus `Contract`.
+    """
+    Label = lm_head.resolve_axis(Label)
+
+    if block_size is None or block_size >= Label.size:
+        logits = hax.dot(embeddings, lm_head, axis=Contract)
+        return entropy_from_logits(logits, axis=Label), top2_gap_from_logits(logits, axis=Label)
+
+    Out = hax.eliminate_axes(embeddings.axes, Contract)
+    num_blocks = Label.size // block_size
+
+    # Running statistics, all with axes Out. With m the running max, z = sum(exp(l - m)) and w = sum(exp(l - m) * l)
+    # over the logits l seen so far, the entropy is log(z) + m - w / z.
+    initial_max = hax.full(Out, -jnp.inf)
+    initial_z = hax.zeros(Out)
+    initial_w = hax.zeros(Out)
+    initial_top1 = hax.full(Out, -jnp.inf)
+    initial_top2 = hax.full(Out, -jnp.inf)
+
+    def process_block(block_idx, acc, current_block_size):
+        max_prev, z_prev, w_prev, top1_prev, top2_prev = acc
+
+        start = block_idx * block_size
+        Block = Label.resize(current_block_size)
+
+        lm_head_b = lm_head[Label, hax.dslice(start, Block)]
+        logits_b = hax.dot(embeddings, lm_head_b, axis=Contract).astype(jnp.float32)
+
+        max_logit = hax.maximum(max_prev, hax.max(logits_b, axis=Block))
+        rescale = hax.exp(max_prev - max_logit)
+        exp_b = hax.exp(logits_b - max_logit)
+        z = z_prev * rescale + hax.sum(exp_b, axis=Block)
+        w = w_prev * rescale + hax.sum(exp_b * logits_b, axis=Block)
+
+        if current_block_size > 1:
+            block_top = hax.top_k(logits_b, Block, 2)[0]
+            block_top1, block_top2 = block_top[Block.name, 0], block_top[Block.name, 1]
+        else:
+            block_top1, block_top2 = logits_b[Block.name, 0], hax.full(Out, -jnp.inf)
+        top1 = hax.maximum(top1_prev, block_top1)
+        top2 = hax.maximum(hax.minimum(top1_prev, block_top1), hax.maximum(top2_prev, block_top2))
+
+        return max_logit, z, w, top1, top2
+
+    acc = (initial_max, initial_z, initial_w, initial_top1, initial_top2)
+    acc = jax.lax.fori_loop(0, num_blocks, functools.partial(process_block, current_block_size=block_size), acc)
+
+    if Label.size % block_size != 0:
+        acc = process_block(num_blocks, acc, Label.size - num_blocks * block_size)
+
+    max_logit, z, w, top1, top2 = acc
+    entropy = hax.log(z) + max_logit - w / z
+    return entropy, top1 - top2
+
+
+def compute_entropy_and_top2_gap_histograms(
+    model,
+    stats_fn: Callable[[PyTree, B], tuple[hax.NamedArray, hax.NamedArray]],
+    test_data,
+    max_tokens: int = 1024 * 1024,
+    num_bins: int = 64,
+) -> tuple[Histogram, Histogram]:
+    """
+    Computes both the entropy and the top-2 gap histograms (see [compute_entropy_histogram][] and
+    [compute_top2_gap_histogram][]) with a single forward pass per batch.
+
+    Args:
+        model: The model to pass to `stats_fn`.
+        stats_fn: Takes (model, batch) and returns the per-token entropies and top-2 gaps, e.g. via
+            [entropy_and_top2_gap_from_embeddings][].
+        test_data: An iterable of batches.
+        max_tokens: Stop taking batches once this many tokens are covered.
+        num_bins: The number of bins in each histogram.
+
+    Returns:
+        tuple[Histogram, Histogram]: The entropy histogram and the top-2 gap histogram.
+    """
+    batches = _take_batches_for_tokens(stats_fn, model, test_data, max_tokens)
+    if not batches:
+        raise ValueError("No tokens processed")
+
+    # Run all the batches that share the first one's shapes in a single compiled loop, rather than dispatching
+    # once per batch. Anything ragged (e.g. a short final batch) is done on its own.
+    uniform = [b for b in batches if _leaf_shapes(b) == _leaf_shapes(batches[0])]
+    ragged = [b for b in batches if _leaf_shapes(b) != _leaf_shapes(batches[0])]
+
+    Batches = hax.Axis("__batches__", len(uniform))
+    entropy_vals, gap_vals = _compute_entropy_and_top2_gap_scanned(
+        stats_fn, model, _stack_batches(Batches, uniform), Batches
+    )
+    entropies_list: list[hax.NamedArray] = [entropy_vals]
+    gaps_list: list[hax.NamedArray] = [gap_vals]
+
+    for batch in ragged:
+        entropy_vals, gap_vals = _compute_entropy_and_top2_gap_on_device(stats_fn, model, batch)
+        entropies_list.append(entropy_vals)
+        gaps_list.append(gap_vals)
+
+    if not sum(e.size for e in entropies_list):
+        raise ValueError("No tokens processed")
+
+    # The per-token values stay sharded like the logits they came from: each device bins its own shard and only the
+    # bin counts are reduced across devices.
+    return _histograms_from_named_arrays(entropies_list, gaps_list, num_bins)
+
+
+def _take_batches_for_tokens(stats_fn, model, test_data, max_tokens: int) -> list:
+    """Takes batches from test_data until they cover at least max_tokens tokens (or the data runs out)."""
+    batches = []
+    tokens_per_shape: dict = {}
+    total_tokens = 0
+    for batch in test_data:
+        batches.append(batch)
+
+        shapes = _leaf_shapes(batch)
+        if shapes not in tokens_per_shape:
+            entropy_shape, _ = eqx.filter_eval_shape(stats_fn, model, batch)
+            tokens_per_shape[shapes] = entropy_shape.size
+        total_tokens += tokens_per_shape[shapes]
+
+        if total_tokens >= max_tokens:
+            break
+
+    return batches
+
+
+def _leaf_shapes(tree) -> tuple:
+    return tuple(leaf.shape for leaf in jax.tree.leaves(tree))
+
+
+def _stack_batches(Batches: hax.Axis, batches: list):
+    def stack(*leaves):
+        if isinstance(leaves[0], hax.NamedArray):
+            return hax.stack(Batches, leaves)
+        return jnp.stack(leaves)
+
+    return jax.tree.map(stack, *batches, is_leaf=lambda x: isinstance(x, hax.NamedArray))
+
+
+@eqx.filter_jit
+def _compute_entropy_and_top2_gap_scanned(
+    stats_fn, model, stacked_batches, Batches: hax.Axis
+) -> tuple[hax.NamedArray, hax.NamedArray]:
+    return hax.map(lambda batch: stats_fn(model, batch), Batches)(stacked_batches)
+
+
+@eqx.filter_jit
+def _compute_entropy_and_top2_gap_on_device(stats_fn, model, batch: B) -> tuple[hax.NamedArray, hax.NamedArray]:
+    return stats_fn(model, batch)
+
+
+@eqx.filter_jit
+def _histograms_from_named_arrays(
+    entropies: list[hax.NamedArray], gaps: list[hax.NamedArray], num_bins: int
+) -> tuple[Histogram, Histogram]:
+    return Histogram.from_named_arrays(entropies, num_bins), Histogram.from_named_arrays(gaps, num_bins)
+
+
 def cb_compute_top2_gap(
     logit_fn,
     Vocab: hax.AxisSelector,
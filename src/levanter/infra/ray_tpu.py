@@ -1,19 +1,25 @@
 from abc import ABC, abstractmethod
+import asyncio
 import dataclasses
+import enum
+import functools
 import logging
 import multiprocessing
 import os
 import socket
 import subprocess
 import tempfile
+import threading
 import time
-from asyncio import QueueEmpty
+import uuid
+import warnings
+from array import array
 from dataclasses import dataclass
-from typing import Callable, Generic, Optional, Sequence, TypeVar
+from typing import Callable, Generic, Literal, Optional, Sequence, TypeVar
 
 import draccus
-import mergedeep
 import ray
+from ray import cloudpickle
 from ray._private.accelerators import TPUAcceleratorManager
 from ray.actor import ActorHandle
 from ray.dag import FunctionNode
@@ -33,6 +39,7 @@ from ray.remote_function import RemoteFunction
 from ray.util.scheduling_strategies import NodeAffinitySchedulingStrategy
 
 from levanter.infra.docker import make_docker_run_command
+from levanter.infra.tpus import get_current_tpu_is_preempted
 from levanter.utils.ray_utils import ser_exc_info
 
 
@@ -124,6 +131,54 @@ class TpuCancelled(_TpuRunResult):
     error: Exception
 
 
+class _TpuStatus(enum.IntEnum):
+    SUCCESS = 0
+    PREEMPTED = 1
+    FAILED = 2
+    RUN_ERROR = 3
+    CANCELLED = 4
+
+
+_RESULT_TYPE_TO_STATUS: dict[type, _TpuStatus] = {
+    TpuSuccess: _TpuStatus.SUCCESS,
+    TpuPreempted: _TpuStatus.PREEMPTED,
+    TpuFailed: _TpuStatus.FAILED,
+    TpuRunError: _TpuStatus.RUN_ERROR,
+    TpuCancelled: _TpuStatus.CANCELLED,
+}
+
+
+@dataclass
+class _SliceResults:
+    """
+    Struct-of-arrays form of the results of running a function on every host of a slice. This is much cheaper to
+    ship around and summarize than one `_TpuRunResult` per host.
+    """
+
+    statuses: array  # one _TpuStatus per host
+    values: list  # the results of the successful hosts, in host order
+    errors: dict[int, Exception]  # host index -> error for preempted/failed hosts (cancelled hosts have no error)
+
+    @staticmethod
+    def from_results(results: Sequence[_TpuRunResult]) -> "_SliceResults":
+        out = _SliceResults(array("b"), [], {})
+        for i, result in enumerate(results):
+            status = _RESULT_TYPE_TO_STATUS[type(result)]
+            out.statuses.append(status)
+            if status == _TpuStatus.SUCCESS:
+                out.values.append(result.result)  # type: ignore
+            elif status != _TpuStatus.CANCELLED:
+                out.errors[i] = result.error  # type: ignore
+        return out
+
+    @staticmethod
+    def cancelled() -> "_SliceResults":
+        return _SliceResults(array("b", [_TpuStatus.CANCELLED]), [], {})
+
+    def all_succeeded(self) -> bool:
+        return self.statuses.count(_TpuStatus.SUCCESS) == len(self.statuses)
+
+
 @dataclass
 class MultisliceInfo:
     """
@@ -162,9 +217,11 @@ class TPUHostInfo:
 
 # Timeouts (in seconds)
 _HEALTH_CHECK_TIMEOUT = 60
+_HEALTH_CHECK_INTERVAL = 10
 _TEARDOWN_ACTOR_TIMEOUT = 300
 _TERMINATE_ACTOR_TIMEOUT = 300
-_START_ACTOR_TIMEOUT = 7 * 24 * 60 * 60  # 1 week
+_CANCEL_TIMEOUT = 5
+_START_ACTOR_TIMEOUT = 20 * 60
 
 
 def _multislice_info_from_head(head: SliceInfo, slice_id: int, num_slices: int) -> MultisliceInfo:
@@ -192,6 +249,18 @@ def _multislice_info_to_env_vars(multislice: MultisliceInfo) -> dict[str, str]:
     return mxla_env
 
 
+def _get_local_ip() -> str:
+    """
+    Get the IPv4 address of this host. Uses a forward lookup of the hostname, which avoids the reverse-DNS
+    round trip that `socket.gethostbyname` can incur.
+    """
+    hostname = socket.gethostname()
+    try:
+        return str(socket.getaddrinfo(hostname, None, family=socket.AF_INET)[0][4][0])
+    except (socket.gaierror, IndexError):
+        return socket.gethostbyname(hostname)
+
+
 ActorInfoT = TypeVar('ActorInfoT')
 
 
@@ -204,9 +273,30 @@ class ActorPoolMember(Generic[ActorInfoT]):
 SliceResource = ActorPoolMember[SliceInfo]
 
 
+class _LazyStr:
+    """Defers building a string until it's needed, e.g. for %-style logging arguments."""
+
+    def __init__(self, fn: Callable[[], str]):
+        self._fn = fn
+
+    def __str__(self) -> str:
+        return self._fn()
+
+
+def _actor_id(actor: ActorHandle) -> str:
+    """A stable identifier for an actor, used to key actor pools."""
+    return actor._actor_id.hex()
+
+
 class ResourcePoolManager(ABC, Generic[ActorInfoT]):
-    def __init__(self):
-        self._actor_pool: list[ActorPoolMember[ActorInfoT]] = []
+    def __init__(self, start_actor_timeout: float = _START_ACTOR_TIMEOUT):
+        # keyed by actor id (see _actor_id)
+        self._actor_pool: dict[str, ActorPoolMember[ActorInfoT]] = {}
+        # how long to wait for a new actor to start before giving up on it
+        self._start_actor_timeout = start_actor_timeout
+        # actors that may have gone bad since they were last known to be healthy. Only these are health checked
+        # when scaling the pool; everyone else is assumed to still be healthy.
+        self._suspect_actor_ids: set[str] = set()
 
     @abstractmethod
     def get_actor_pool_name(self) -> str:
@@ -225,37 +315,61 @@ class ResourcePoolManager(ABC, Generic[ActorInfoT]):
         raise NotImplementedError()
 
     def get_all_actors_in_pool(self) -> list[ActorHandle]:
-        return [member.actor for member in self._actor_pool]
+        return [member.actor for member in self._actor_pool.values()]
 
     def get_all_pool_members(self) -> list[ActorPoolMember[ActorInfoT]]:
-        return self._actor_pool.copy()
+        return list(self._actor_pool.values())
+
+    def _lazy_member_names(self) -> "_LazyStr":
+        """The names of the pool's members, only formatted if they actually get logged."""
+        return _LazyStr(lambda: str([self.get_actor_name_from_actor_info(member.actor_info) for member in self._actor_pool.values()]))
+
+    def mark_suspect(self, member: ActorPoolMember[ActorInfoT]) -> None:
+        """Mark a member as possibly unhealthy, so that it is health checked the next time the pool is scaled."""
+        self._suspect_actor_ids.add(_actor_id(member.actor))
 
     def _remove_unhealthy_members_from_actor_pool(self) -> None:
-        logger.info(f"{self.get_actor_pool_name()} actor pool members before removing unhealthy members: {[self.get_actor_name_from_actor_info(member.actor_info) for member in self._actor_pool]}")
-        members_and_health = [(member, member.actor.healthy.remote()) for member in self._actor_pool]
-        healthy_members: list[ActorPoolMember[ActorInfoT]] = []
-        unhealthy_members: list[ActorPoolMember[ActorInfoT]] = []
-        for member, health in members_and_health:
+        if not self._suspect_actor_ids:
+            # nothing has gone wrong since the last time we checked, so skip the health checks entirely
+            return
+
+        logger.info("%s actor pool members before removing unhealthy members: %s", self.get_actor_pool_name(), self._lazy_member_names())
+        members_and_health = [
+            (actor_id, member, member.actor.healthy.remote())
+            for actor_id, member in self._actor_pool.items()
+            if actor_id in self._suspect_actor_ids
+        ]
+        self._suspect_actor_ids.clear()
+        # Fire all health checks at once and harvest them within a single timeout window, rather than waiting
+        # up to _HEALTH_CHECK_TIMEOUT per member.
+        ready_health: set[ray.ObjectRef] = set()
+        if members_and_health:
+            health_futures = [health for _, _, health in members_and_health]
+            ready, _ = ray.wait(health_futures, num_returns=len(health_futures), timeout=_HEALTH_CHECK_TIMEOUT)
+            ready_health = set(ready)
+
+        unhealthy_actor_ids: list[str] = []
+        for actor_id, member, health in members_and_health:
+            if health not in ready_health:
+                logger.warning(f"{self.get_actor_pool_name()} actor pool member {self.get_actor_name_from_actor_info(member.actor_info)} did not respond to health check within {_HEALTH_CHECK_TIMEOUT} seconds. Removing from actor pool.")
+                unhealthy_actor_ids.append(actor_id)
+                continue
             try:
-                if ray.get(health, timeout=_HEALTH_CHECK_TIMEOUT):
-                    healthy_members.append(member)
-                else:
+                if not ray.get(health, timeout=0):
                     logger.warning(f"{self.get_actor_pool_name()} actor pool member {self.get_actor_name_from_actor_info(member.actor_info)} is unhealthy. Removing from actor pool.")
-                    unhealthy_members.append(member)
+                    unhealthy_actor_ids.append(actor_id)
             except (RayActorError, RayTaskError, ActorDiedError, ActorUnavailableError, GetTimeoutError) as e:
                 logger.warning(f"{self.get_actor_pool_name()} actor pool member {self.get_actor_name_from_actor_info(member.actor_info)} is dead or unavailable. Removing from actor pool. Error: {e}")
-                unhealthy_members.append(member)
+                unhealthy_actor_ids.append(actor_id)
 
-        # NOTE: For simplicity, we serially process the unhealthy actors, rather than doing it in parallel.
-        for unhealthy_member in unhealthy_members:
-            # This is a synchronous blocking call.
-            _stop_actor(unhealthy_member.actor)
+        # Stop the unhealthy actors concurrently. This blocks until all of them are stopped.
+        unhealthy_members = [self._actor_pool.pop(actor_id) for actor_id in unhealthy_actor_ids]
+        _stop_actors([member.actor for member in unhealthy_members])
 
-        self._actor_pool = healthy_members
-        logger.info(f"{self.get_actor_pool_name()} actor pool members after unhealthy members: {[self.get_actor_name_from_actor_info(member.actor_info) for member in self._actor_pool]}")
+        logger.info("%s actor pool members after unhealthy members: %s", self.get_actor_pool_name(), self._lazy_member_names())
 
     def _add_members_to_actor_pool(self, desired_num_actors: int) -> None:
-        logger.info(f"{self.get_actor_pool_name()} actor pool members before adding members: {[self.get_actor_name_from_actor_info(member.actor_info) for member in self._actor_pool]}")
+        logger.info("%s actor pool members before adding members: %s", self.get_actor_pool_name(), self._lazy_member_names())
         if len(self._actor_pool) >= desired_num_actors:
             logger.info(f"{self.get_actor_pool_name()} actor pool has {len(self._actor_pool)} members, and we wanted {desired_num_actors}. Skipping adding members.")
             return
@@ -265,19 +379,37 @@ class ResourcePoolManager(ABC, Generic[ActorInfoT]):
 
         actors = [self.create_actor() for _ in range(desired_num_actors - len(self._actor_pool))]
 
-        actors_and_actor_info_awaitables = [(actor, self.get_actor_info_future(actor)) for actor in actors]
+        actor_info_awaitable_to_actor = {self.get_actor_info_future(actor): actor for actor in actors}
         logger.info(f"{self.get_actor_pool_name()} actor pool waiting for {len(actors)} new actors to start...")
-        for actor, actor_info_awaitable in actors_and_actor_info_awaitables:
+        # Wait on all of the actors at once and add them to the pool as they come up, so that one slow actor
+        # doesn't hold up the others.
+        deadline = time.time() + self._start_actor_timeout
+        pending = list(actor_info_awaitable_to_actor)
+        while pending:
+            ready, pending = ray.wait(pending, num_returns=1, timeout=max(0.0, deadline - time.time()))
+            if not ready:
+                break
+            for actor_info_awaitable in ready:
+                actor = actor_info_awaitable_to_actor[actor_info_awaitable]
+                try:
+                    actor_info: ActorInfoT = ray.get(actor_info_awaitable, timeout=0)
+                except Exception as e:
+                    logger.exception(f"{self.get_actor_pool_name()} actor pool actor {actor} failed to start: {e}")
+                    _stop_actor(actor)
+                    continue
+                logger.info(f"{self.get_actor_pool_name()} actor pool member {self.get_actor_name_from_actor_info(actor_info)} started.")
+                self._actor_pool[_actor_id(actor)] = ActorPoolMember[ActorInfoT](actor, actor_info)
+
+        for actor_info_awaitable in pending:
+            actor = actor_info_awaitable_to_actor[actor_info_awaitable]
+            logger.error(f"{self.get_actor_pool_name()} actor pool actor {actor} failed to start within {self._start_actor_timeout} seconds.")
             try:
-                actor_info: ActorInfoT = ray.get(actor_info_awaitable, timeout=_START_ACTOR_TIMEOUT)  # TODO: make this overridable
-            except Exception as e:
-                logger.exception(f"{self.get_actor_pool_name()} actor pool actor {actor} failed to start: {e}")
-                _stop_actor(actor)
-                continue
-            logger.info(f"{self.get_actor_pool_name()} actor pool member {self.get_actor_name_from_actor_info(actor_info)} started.")
-            self._actor_pool.append(ActorPoolMember[ActorInfoT](actor, actor_info))
+                ray.cancel(actor_info_awaitable)
+            except Exception:
+                logger.exception(f"Failed to cancel actor info request for {actor}")
+            _stop_actor(actor)
 
-        logger.info(f"{self.get_actor_pool_name()} actor pool members after adding members: {[self.get_actor_name_from_actor_info(member.actor_info) for member in self._actor_pool]}")
+        logger.info("%s actor pool members after adding members: %s", self.get_actor_pool_name(), self._lazy_member_names())
         logger.info(f"{self.get_actor_pool_name()} actor pool scaled up to {len(self._actor_pool)} members")
 
         if len(self._actor_pool) < desired_num_actors:
@@ -289,18 +421,20 @@ class ResourcePoolManager(ABC, Generic[ActorInfoT]):
         # TODO: Add retry logic
 
     def drain_actor_pool(self) -> None:
-        logger.info(f"{self.get_actor_pool_name()} actor pool members before draining: {[self.get_actor_name_from_actor_info(member.actor_info) for member in self._actor_pool]}")
-        for member in self._actor_pool:
-            logger.info(f"{self.get_actor_pool_name()} actor pool member {self.get_actor_name_from_actor_info(member.actor_info)} stopping.")
-            _stop_actor(member.actor)
-        self._actor_pool = []
+        logger.info("%s actor pool members before draining: %s", self.get_actor_pool_name(), self._lazy_member_names())
+        if logger.isEnabledFor(logging.INFO):
+            for member in self._actor_pool.values():
+                logger.info(f"{self.get_actor_pool_name()} actor pool member {self.get_actor_name_from_actor_info(member.actor_info)} stopping.")
+        _stop_actors([member.actor for member in self._actor_pool.values()])
+        self._actor_pool.clear()
+        self._suspect_actor_ids.clear()
         logger.info(f"{self.get_actor_pool_name()} actor pool drained.")
 
 
 
 class SlicePoolManager(ResourcePoolManager[SliceInfo]):
-    def __init__(self, tpu_type: str):
-        super().__init__()
+    def __init__(self, tpu_type: str, start_actor_timeout: float = _START_ACTOR_TIMEOUT):
+        super().__init__(start_actor_timeout)
         self._tpu_type = tpu_type
 
     def get_actor_pool_name(self) -> str:
@@ -317,7 +451,10 @@ class SlicePoolManager(ResourcePoolManager[SliceInfo]):
 
 
 
-@ray.remote
+# Cancellation and health checks get their own concurrency groups, so that they don't queue behind
+# wait_for_results or slow methods like get_slice_info and teardown. Everything else (which mutates the pool and the
+# slice state) stays in the default group, which runs one method at a time.
+@ray.remote(concurrency_groups={"health": 1, "cancel": 1})  # type: ignore
 class SliceActor(ResourcePoolManager[TPUHostInfo]):
     """
     Actor that manages a single TPU slice.
@@ -326,17 +463,18 @@ class SliceActor(ResourcePoolManager[TPUHostInfo]):
         super().__init__()
         self._failed = False
         self._slice_info: Optional[SliceInfo] = None
+        self._host_futures: list[ray.ObjectRef] = []
 
+    @ray.method(concurrency_group="health")
     def healthy(self) -> bool:
-        return not self._failed and not self.is_being_preempted()
+        return not self._failed and not get_current_tpu_is_preempted()
 
+    @ray.method(concurrency_group="health")
     def is_being_preempted(self) -> bool:
         """
         Check if the TPU slice is being preempted.
         This is a workaround for the fact that Ray doesn't expose this information directly.
         """
-        from levanter.infra.tpus import get_current_tpu_is_preempted
-
         return get_current_tpu_is_preempted()
 
     def get_actor_pool_name(self) -> str:
@@ -355,42 +493,104 @@ class SliceActor(ResourcePoolManager[TPUHostInfo]):
         return actor.get_host_info.remote()
 
     def get_slice_info(self):
+        # The topology of the slice doesn't change over the lifetime of the actor, so we only look it up once.
+        if self._slice_info is None:
+            self._slice_info = self._query_slice_info()
+        self.scale_actor_pool(self._slice_info.num_hosts)
+        return self._slice_info
+
+    def _query_slice_info(self) -> SliceInfo:
         pod_name = ray.util.accelerators.tpu.get_current_pod_name()
         num_hosts = ray.util.accelerators.tpu.get_current_pod_worker_count()
         num_tpus_per_host = TPUAcceleratorManager.get_current_node_num_accelerators()
-        tpe = TPUAcceleratorManager._get_current_node_tpu_pod_type()
+        tpe = TPUAcceleratorManager._get_current_node_tpu_pod_type()  # type: ignore
+        if pod_name is None or num_hosts is None or tpe is None:
+            raise RuntimeError("Couldn't determine the TPU slice this actor is running on")
         # there seems to be a bug with some version of ray here
         if tpe.startswith("v4") or tpe.startswith("v5"):
             num_cores = int(tpe.split("-")[1])
             num_tpus_per_host = 4
             num_hosts = num_cores // 8
-        ip_address = socket.gethostbyname(socket.gethostname())
-        self._slice_info = SliceInfo(
+        return SliceInfo(
             slice_name=pod_name,
             num_hosts=num_hosts,
             num_tpus_per_host=num_tpus_per_host,
-            ip_address=ip_address,
+            ip_address=_get_local_ip(),
         )
-        self.scale_actor_pool(num_hosts)
-        return self._slice_info
 
-    def run_remote_fn(self, remote_fn: RemoteFunction, runtime_env: dict) -> list[ray.ObjectRef]:
+    def run_remote_fn(
+        self, remote_fn_box: tuple[ray.ObjectRef], runtime_env: dict, mxla_env: dict[str, str] | None = None
+    ) -> None:
         """Run the remote function on this slice.
 
+        Args:
+            remote_fn_box: A 1-tuple holding an ObjectRef to the remote function, so that Ray doesn't resolve it here.
+
         NOTE: This runs the remote function in a different task. It does not block on the remote function call.
-        NOTE: This returns a list of Ray futures. If calling this method on a remote Actor, you will get a future of a list of futures."""
+        Use `wait_for_results` to wait for the results."""
         actors = self.get_all_actors_in_pool()
         if not self._slice_info or len(actors) < self._slice_info.num_hosts:
             raise Exception("Insufficient host actors; call setup() before calling run_remote_fn()")
-        futures_of_futures: list[ray.ObjectRef] = [actor.run_remote_fn.remote(remote_fn, runtime_env) for actor in actors]
-        return [ray.get(future_of_future) for future_of_future in futures_of_futures]
+        # The function is already in the object store; put the multislice env vars there too and share them between
+        # all hosts, rather than serializing them separately for each host.
+        (remote_fn_ref,) = remote_fn_box
+        mxla_env_ref = ray.put(mxla_env) if mxla_env is not None else None
+        futures_of_futures: list[ray.ObjectRef] = [
+            actor.run_remote_fn.remote(remote_fn_ref, runtime_env, mxla_env_ref) for actor in actors
+        ]
+        # a single batched get rather than one round trip per host
+        self._host_futures = ray.get(futures_of_futures)
+
+    def wait_for_results(self) -> _SliceResults:
+        """Wait for the hosts of the last `run_remote_fn` call to finish and return their results.
+
+        If any host fails, the remaining hosts are cancelled and reported as cancelled."""
+        futures = list(self._host_futures)
+        future_to_index = {future: i for i, future in enumerate(futures)}
+        statuses = array("b", [_TpuStatus.CANCELLED] * len(futures))
+        values: list = [None] * len(futures)
+        errors: dict[int, Exception] = {}
+
+        pending = futures
+        had_a_failure = False
+        while pending and not had_a_failure:
+            finished, pending = ray.wait(pending, num_returns=1, fetch_local=False)
+            for f in finished:
+                index = future_to_index[f]
+                result = _get_tpu_result(f)
+                statuses[index] = _RESULT_TYPE_TO_STATUS[type(result)]
+                if isinstance(result, TpuSuccess):
+                    values[index] = result.result
+                else:
+                    errors[index] = result.error  # type: ignore
+                    had_a_failure = True
+
+        for f in pending:
+            try:
+                ray.cancel(f, force=True)
+            except Exception:
+                logger.exception(f"Failed to cancel {f}")
+
+        if had_a_failure:
+            values = [value for value, status in zip(values, statuses) if status == _TpuStatus.SUCCESS]
+        return _SliceResults(statuses, values, errors)
+
+    @ray.method(concurrency_group="cancel")
+    def cancel_remote_fn(self) -> None:
+        """Cancel the hosts' tasks from the last `run_remote_fn` call, e.g. because another slice failed."""
+        for f in self._host_futures:
+            try:
+                ray.cancel(f, force=True)
+            except Exception:
+                logger.exception(f"Failed to cancel {f}")
 
     def teardown(self):
+        # the slice info is left alone: the topology doesn't change, so get_slice_info can reuse it
         self.drain_actor_pool()
-        self._slice_info = None
+        self._host_futures = []
 
 
-@ray.remote
+@ray.remote(concurrency_groups={"health": 1})  # type: ignore
 class TPUHostActor:
     """
     Actor that manages a single TPU host.
@@ -400,13 +600,16 @@ class TPUHostActor:
         self._awaitable: Optional[ray.ObjectRef] = None
         self._host_info: Optional[TPUHostInfo] = None
         self._slice_info = slice_info
+        # A previous task on this host (e.g. from an earlier actor) may have left a lockfile behind. After this,
+        # only our own tasks can leave one, so we only need to clean up again when we've launched something.
+        _hacky_remove_tpu_lockfile()
 
+    @ray.method(concurrency_group="health")
     def healthy(self) -> bool:
-        return not self.is_being_preempted()
+        return not get_current_tpu_is_preempted()
 
+    @ray.method(concurrency_group="health")
     def is_being_preempted(self) -> bool:
-        from levanter.infra.tpus import get_current_tpu_is_preempted
-
         return get_current_tpu_is_preempted()
 
     def get_host_info(self) -> TPUHostInfo:
@@ -421,17 +624,20 @@ class TPUHostActor:
         )
         return self._host_info
 
-    def run_remote_fn(self, remote_fn: RemoteFunction, runtime_env: dict) -> ray.ObjectRef:
-        """Run the remote function on this host.
+    def run_remote_fn(self, remote_fn: RemoteFunction, runtime_env: dict, mxla_env: dict[str, str] | None = None) -> ray.ObjectRef:
+        """Run the remote function on this host. `mxla_env` (if any) is added to the runtime env's env vars.
 
         NOTE: This runs the remote function in a different task. It does not block on the remote function call.
         NOTE: This returns a Ray future. If calling this method on a remote Actor, you will get a future of a future."""
         if not self._host_info:
             raise Exception("Call setup() before calling run_remote_fn()")
 
-        if self._awaitable:
+        if mxla_env is not None:
+            runtime_env = _add_env_vars_to_runtime_env(runtime_env, mxla_env)
+
+        if self._awaitable is not None:
             ray.cancel(self._awaitable, force=True, recursive=True)
-        _hacky_remove_tpu_lockfile()
+            _hacky_remove_tpu_lockfile()
 
         self._awaitable = remote_fn.options(
             scheduling_strategy=NodeAffinitySchedulingStrategy(self._host_info.node_id, soft=False),
@@ -454,6 +660,34 @@ class TPUHostActor:
 
 
 
+@ray.remote(num_cpus=0)
+class SliceHealthMonitor:
+    """
+    Actor that periodically checks the health of a set of slice actors, so that callers only need to wait on a
+    single future rather than polling every slice themselves.
+    """
+
+    def __init__(self, slice_actors: list[ActorHandle], check_interval: float = _HEALTH_CHECK_INTERVAL):
+        self._slice_actors = slice_actors
+        self._check_interval = check_interval
+
+    async def wait_for_unhealthy_slices(self) -> list[int]:
+        """Block until at least one slice is unhealthy, then return the indices of the unhealthy slices."""
+        while True:
+            healths = await asyncio.gather(*[self._is_healthy(actor) for actor in self._slice_actors])
+            unhealthy = [i for i, healthy in enumerate(healths) if not healthy]
+            if unhealthy:
+                return unhealthy
+            await asyncio.sleep(self._check_interval)
+
+    async def _is_healthy(self, actor: ActorHandle) -> bool:
+        try:
+            return await asyncio.wait_for(actor.healthy.remote(), timeout=_HEALTH_CHECK_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Failed to get health of actor {actor}", exc_info=e)
+            return False
+
+
 def run_on_pod(
     remote_fn: RemoteFunction | Callable,
     tpu_type: str,
@@ -461,6 +695,7 @@ def run_on_pod(
     num_slices: int = 1,
     max_retries_preemption=10000,
     max_retries_failure=10,
+    isolate: Literal["worker", "process"] = "worker",
 ):
     """
     Repeatedly run a function on a TPU pod until it succeeds or a maximum number of retries is reached.
@@ -473,6 +708,8 @@ def run_on_pod(
         tpu_type: The type of TPU to run on, e.g. "v4-32"
         max_retries_preemption: The maximum number of times to retry if the job is preempted
         max_retries_failure: The maximum number of times to retry if the job fails
+        isolate: How to isolate each run of the function. "worker" relies on `max_calls=1` to give each run a fresh
+            Ray worker. "process" additionally runs the function in a separate process inside that worker.
 
     Returns:
         The result of the function (not an ObjectRef)
@@ -481,7 +718,9 @@ def run_on_pod(
     if num_slices <= 0:
         raise ValueError("num_slices must be greater than 0")
 
-    return ray.get(run_on_pod_ray.remote(remote_fn, tpu_type, num_slices, max_retries_preemption, max_retries_failure))
+    return ray.get(
+        run_on_pod_ray.remote(remote_fn, tpu_type, num_slices, max_retries_preemption, max_retries_failure, isolate)
+    )
 
 
 @ray.remote(num_cpus=0.01)
@@ -491,11 +730,13 @@ def run_on_pod_ray(
     num_slices: int = 1,
     max_retries_preemption: int = 10000,
     max_retries_failure: int = 10,
+    isolate: Literal["worker", "process"] = "worker",
 ):
     """
     Repeatedly run a function on a TPU pod until it succeeds or a maximum number of retries is reached.
 
     This function is a Ray remote function that can be called from anywhere in the Ray cluster.
+    See `run_on_pod` for the arguments.
     """
     if num_slices <= 0:
         raise ValueError("num_slices must be greater than 0")
@@ -519,6 +760,15 @@ def run_on_pod_ray(
     elif remote_fn._default_options.get("max_calls") is None:
         raise ValueError("Remote function must have max_calls set to 1 for TPU workloads.")
 
+    if isolate == "process":
+        remote_fn = _forkify_remote_fn(remote_fn)
+    elif isolate != "worker":
+        raise ValueError(f"Unknown isolation mode {isolate}")
+
+    # Serialize the function (and whatever it closes over) once for all attempts and slices, not once per launch.
+    remote_fn_ref = ray.put(remote_fn)
+    runtime_env = remote_fn._runtime_env or {}
+
     slice_pool_manager = SlicePoolManager(tpu_type)
 
     try:
@@ -537,115 +787,123 @@ def run_on_pod_ray(
                 num_preemptions += 1
                 continue
 
-            # If we're doing multislice, we need to get the slice info from the first actor
+            # If we're doing multislice, we need to get the slice info from the first actor. Single slice jobs don't
+            # need any of the multislice env vars, so we skip building them entirely.
             head_slice_info = slice_pool[0].actor_info if len(slice_pool) > 1 else None
 
-            # Ok finally time to run the remote function on all slices
-            futures: list[ray.ObjectRef] = []  # one per host in each slice
-            future_to_index: dict[ray.ObjectRef, int] = {}  # maps futures to their index in the results list
-            global_index = 0  # index into results list
-
+            # Ok finally time to run the remote function on all slices. Each slice actor waits on its own hosts and
+            # reports back a single future, so we only have to track one future per slice here.
+            slice_futures: list[ray.ObjectRef] = []  # one per slice
             for i, tpu_slice in enumerate(slice_pool):
+                mxla_env: dict[str, str] | None = None
                 if head_slice_info is not None:
                     multislice_info = _multislice_info_from_head(head_slice_info, i, len(slice_pool))
                     mxla_env = _multislice_info_to_env_vars(multislice_info)
-                else:
-                    mxla_env = {}
 
-                futures_for_slice = _start_fn_on_slice(tpu_slice.actor, remote_fn, mxla_env)
-                logger.info(f"Futures for slice {slice_pool[0].actor_info.slice_name}: {futures_for_slice}")
+                slice_future = _start_fn_on_slice(tpu_slice.actor, remote_fn_ref, runtime_env, mxla_env)
+                logger.info(f"Future for slice {tpu_slice.actor_info.slice_name}: {slice_future}")
+                slice_futures.append(slice_future)
 
-                futures.extend(futures_for_slice)
-                for future in futures_for_slice:
-                    future_to_index[future] = global_index
-                    global_index += 1
+            slice_results: list[_SliceResults | None] = [None] * len(slice_futures)
+            future_to_slice_index = {future: i for i, future in enumerate(slice_futures)}
 
-            tpu_results: list[_TpuRunResult | None] = [None] * len(futures)
-
-            # We wait for jobs to finish one at a time. If a preemption or failure occurs, we cancel all
-            pending_futures = list(futures)
+            # We wait for slices to finish one at a time. If a preemption or failure occurs, we cancel all
+            pending_futures = set(slice_futures)
             had_a_failure = False
 
-            # check health of actors in the loop too
-            actor_health_futures = [tpu_slice.actor.healthy.remote() for actor in slice_pool]
-
-            while pending_futures and not had_a_failure:
-                finished, pending_futures = ray.wait(pending_futures, num_returns=1, timeout=10.0)
-
-                for f in finished:
-                    try:
-                        tpu_results[future_to_index[f]] = TpuSuccess(ray.get(f))
-                    except RayError as e:
-                        had_a_failure = True
-                        problems.append(e)
-                        tpu_results[future_to_index[f]] = _handle_ray_error(e)
-                    except Exception as e:
-                        logger.warning(f"Task {f} failed with unexpected error {e}. Will retry.")
-                        had_a_failure = True
-                        tpu_results[future_to_index[f]] = TpuRunError(e)
-
-                if had_a_failure:
-                    # skip health checks if we already had a failure
-                    break
-
-                # Check if any actors are unhealthy. We hit this if it's been 10 seconds or we got a result
-                try:
-                    actor_healths = ray.get(actor_health_futures)
-                except RayError as e:
-                    logger.warning("Failed to get actor healths", exc_info=e)
-                    # assume things are bad
-                    had_a_failure = True
-                else:
-                    for i, healthy in enumerate(actor_healths):
-                        if not healthy:
-                            logger.warning(f"Actor {slice_pool[i]} is unhealthy. Will retry.")
+            # We monitor the health of the slices in the same wait set as the work futures, so that we notice
+            # failures as soon as they happen. The monitor polls all of the slices itself, so we only have to wait
+            # on one future for it.
+            health_monitor = SliceHealthMonitor.remote([tpu_slice.actor for tpu_slice in slice_pool])  # type: ignore
+            unhealthy_slices_future = health_monitor.wait_for_unhealthy_slices.remote()
+
+            try:
+                while pending_futures and not had_a_failure:
+                    # We only need to know which futures are done here; values are fetched with ray.get below.
+                    finished, _ = ray.wait(
+                        [*pending_futures, unhealthy_slices_future],
+                        num_returns=1,
+                        fetch_local=False,
+                    )
+
+                    for f in finished:
+                        if f == unhealthy_slices_future:
+                            try:
+                                unhealthy_slice_indices = ray.get(f)
+                            except RayError as e:
+                                logger.warning("Failed to get actor healths", exc_info=e)
+                                # assume things are bad
+                                unhealthy_slice_indices = list(range(len(slice_pool)))
+
+                            for slice_index in unhealthy_slice_indices:
+                                logger.warning(f"Actor {slice_pool[slice_index]} is unhealthy. Will retry.")
+                                slice_pool_manager.mark_suspect(slice_pool[slice_index])
                             had_a_failure = True
+                            continue
+
+                        pending_futures.remove(f)
+                        slice_index = future_to_slice_index[f]
+                        try:
+                            results_for_slice = ray.get(f)
+                        except RayError as e:
+                            # the slice actor itself died
+                            results_for_slice = _SliceResults.from_results([_handle_ray_error(e)])
+                        except Exception as e:
+                            logger.warning(f"Slice {slice_index} failed with unexpected error {e}. Will retry.")
+                            results_for_slice = _SliceResults.from_results([TpuRunError(e)])
+
+                        slice_results[slice_index] = results_for_slice
+                        if not results_for_slice.all_succeeded():
+                            had_a_failure = True
+            finally:
+                # don't leak the monitor (or its pending wait) if we leave this attempt early
+                ray.kill(health_monitor)
 
             # Proactively cancel jobs if one fails.
             if had_a_failure and pending_futures:
-                logger.info(f"Failure detected. Cancelling {len(pending_futures)} futures.")
-                try:
-                    for f in pending_futures:
-                        ray.cancel(f, force=True)
-                except Exception:
-                    logger.exception("Failed to cancel pending futures")
-
-                # Now, fill in the cancellations
+                logger.info(f"Failure detected. Cancelling {len(pending_futures)} slices.")
+                # Each slice actor cancels its own hosts' tasks. We issue all of the cancellations at once and then
+                # wait (briefly) for them together.
+                cancel_futures = []
                 for f in pending_futures:
-                    index = future_to_index.get(f)
-                    if index is not None:
-                        tpu_results[index] = TpuCancelled(
-                            RuntimeError("Task was cancelled due to a failure in another task")
-                        )
-                    else:
-                        logger.warning(f"Future {f} was not found in future_to_index. Skipping.")
+                    slice_index = future_to_slice_index[f]
+                    cancel_futures.append(slice_pool[slice_index].actor.cancel_remote_fn.remote())
+
+                    # Now, fill in the cancellations
+                    slice_results[slice_index] = _SliceResults.cancelled()
+
+                _, not_cancelled = ray.wait(
+                    cancel_futures, num_returns=len(cancel_futures), timeout=_CANCEL_TIMEOUT, fetch_local=False
+                )
+                if not_cancelled:
+                    logger.warning(f"{len(not_cancelled)} slices did not finish cancelling in {_CANCEL_TIMEOUT} seconds")
 
             # Process results, figure out if we succeeded or failed or preempted
             out_results: list = []
-            any_preempted = False
-            any_failed = False
-            any_cancelled = False
+            status_counts = [0] * len(_TpuStatus)
 
-            for result in tpu_results:
-                if isinstance(result, TpuSuccess):
-                    out_results.append(result.result)
-                elif isinstance(result, TpuPreempted):
-                    problems.append(result.error)
-                    any_preempted = True
-                elif isinstance(result, TpuFailed):
-                    any_preempted = True
-                    problems.append(result.error)
-                    logger.warning(f"TPU node failure. Treating as preempted: {num_preemptions} times")
-                elif isinstance(result, TpuRunError):
-                    problems.append(result.error)
-                    any_failed = True
-                elif isinstance(result, TpuCancelled):
-                    logger.info("TPU job was cancelled, probably because something else failed.")
-                    any_cancelled = True
-                elif result is None:
-                    assert False, "We should never have None results here. "
-                else:
-                    raise RuntimeError(f"Unexpected result: {result}")
+            for slice_index, results_for_slice in enumerate(slice_results):
+                assert results_for_slice is not None, "We should never have None results here."
+                for status in _TpuStatus:
+                    status_counts[status] += results_for_slice.statuses.count(status)
+
+                # Any slice that didn't succeed gets health checked before the next attempt. (Cancelled slices
+                # too: they may have been preempted without us hearing about it first.)
+                if not results_for_slice.all_succeeded():
+                    slice_pool_manager.mark_suspect(slice_pool[slice_index])
+
+                out_results.extend(results_for_slice.values)
+                problems.extend(results_for_slice.errors.values())
+
+            # node failures are treated as preemptions
+            any_preempted = bool(status_counts[_TpuStatus.PREEMPTED] or status_counts[_TpuStatus.FAILED])
+            any_failed = bool(status_counts[_TpuStatus.RUN_ERROR])
+            any_cancelled = bool(status_counts[_TpuStatus.CANCELLED])
+
+            if status_counts[_TpuStatus.FAILED]:
+                logger.warning(f"TPU node failure. Treating as preempted: {num_preemptions} times")
+            if any_cancelled:
+                logger.info("TPU job was cancelled, probably because something else failed.")
 
             if any_preempted:
                 problem = problems[0] if problems else RuntimeError("TPU job was preempted")
@@ -692,36 +950,80 @@ def run_on_pod_ray(
 
 
 def _stop_actor(actor: ActorHandle) -> None:
+    _stop_actors([actor])
+
+
+def _stop_actors(actors: Sequence[ActorHandle]) -> None:
+    """
+    Stop several actors at once. All actors are torn down concurrently, then terminated concurrently, and finally
+    killed, so stopping N actors takes about as long as stopping one.
+    """
+    if not actors:
+        return
+
     try:
         # This is recommended by https://docs.ray.io/en/latest/ray-core/api/doc/ray.kill.html
         #
         # > If you want to kill the actor but let pending tasks finish, you can call actor.__ray_terminate__.remote()
         # > instead to queue a termination task. Any atexit handlers installed in the actor will be run in this case.
         #
-        # NOTE: Not sure if this always returns an exception (because the actor will terminate before finishing)
-        # but it doesn't really matter
-        ray.get(actor.teardown.remote(), timeout=_TEARDOWN_ACTOR_TIMEOUT)
-        ray.get(actor.__ray_terminate__.remote(), timeout=_TERMINATE_ACTOR_TIMEOUT)
-    except ActorDiedError:
-        # This is expected because the actor will terminate within  __ray_terminate__() task,
-        # so the task will never succeed.
-        pass
-    except GetTimeoutError as e:
-        logger.warning(f"Failed to gracefully shut down actor in {_TERMINATE_ACTOR_TIMEOUT} seconds; killing it instead: {e}")
+        # NOTE: __ray_terminate__ probably always "fails" with an ActorDiedError (because the actor terminates before
+        # finishing the task), but ray.wait doesn't raise on errors so it doesn't matter.
+        # We wait for all teardowns before terminating, since actors with max_concurrency > 1 don't run tasks in order.
+        _, not_torn_down = ray.wait(
+            [actor.teardown.remote() for actor in actors],
+            num_returns=len(actors),
+            timeout=_TEARDOWN_ACTOR_TIMEOUT,
+            fetch_local=False,
+        )
+        if not_torn_down:
+            logger.warning(f"{len(not_torn_down)} actors failed to tear down in {_TEARDOWN_ACTOR_TIMEOUT} seconds")
+
+        _, not_terminated = ray.wait(
+            [actor.__ray_terminate__.remote() for actor in actors],
+            num_returns=len(actors),
+            timeout=_TERMINATE_ACTOR_TIMEOUT,
+            fetch_local=False,
+        )
+        if not_terminated:
+            logger.warning(f"Failed to gracefully shut down {len(not_terminated)} actors in {_TERMINATE_ACTOR_TIMEOUT} seconds; killing them instead")
     finally:
-        ray.kill(actor)
+        for actor in actors:
+            ray.kill(actor)
 
 
-def _start_fn_on_slice(slice_actor: ActorHandle, remote_fn: RemoteFunction, mxla_env: dict | None) -> list[ray.ObjectRef]:
+def _start_fn_on_slice(
+    slice_actor: ActorHandle, remote_fn_ref: ray.ObjectRef, runtime_env: dict, mxla_env: dict | None
+) -> ray.ObjectRef:
     """
-    Start the remote function on a slice of the TPU pod.
+    Start the remote function on a slice of the TPU pod. Returns a future for the list of per-host results of the slice.
     """
-    runtime_env = remote_fn._runtime_env or {}
-    if mxla_env is not None:
-        mxla_env = dict(env_vars=mxla_env)
-        runtime_env = mergedeep.merge({}, runtime_env, mxla_env, strategy=mergedeep.Strategy.ADDITIVE)
-    futures_for_slice = ray.get(slice_actor.run_remote_fn.remote(remote_fn, runtime_env))
-    return futures_for_slice
+    # The ref is wrapped so that Ray hands the reference itself to the slice actor instead of resolving it there.
+    ray.get(slice_actor.run_remote_fn.remote((remote_fn_ref,), runtime_env, mxla_env))
+    return slice_actor.wait_for_results.remote()
+
+
+def _add_env_vars_to_runtime_env(runtime_env: dict, env_vars: dict[str, str]) -> dict:
+    """Returns a copy of the runtime env with the given env vars added."""
+    # env_vars is the only nested part of the runtime env we need to merge
+    runtime_env = dict(runtime_env)
+    merged_env_vars = dict(runtime_env.get("env_vars", {}))
+    merged_env_vars.update(env_vars)
+    runtime_env["env_vars"] = merged_env_vars
+    return runtime_env
+
+
+def _get_tpu_result(future: ray.ObjectRef) -> _TpuRunResult:
+    """
+    Get the result of a single TPU host task, classifying any error.
+    """
+    try:
+        return TpuSuccess(ray.get(future))
+    except RayError as e:
+        return _handle_ray_error(e)
+    except Exception as e:
+        logger.warning(f"Task {future} failed with unexpected error {e}. Will retry.")
+        return TpuRunError(e)
 
 
 def _handle_ray_error(e: RayError):
@@ -729,37 +1031,110 @@ def _handle_ray_error(e: RayError):
     Handle a Ray error that occurred on a TPU pod. Tries to determine if the error was due to a
     node failure or preemption or just an application error.
     """
-    # treat node failures as preemptions
-    if isinstance(e, NodeDiedError):
-        logger.exception("Node died", exc_info=e)
-        return TpuPreempted(e)
-    elif isinstance(e, ray.exceptions.ActorUnavailableError | ray.exceptions.ActorDiedError):
-        logger.exception("Actor died", exc_info=e)
+    return _ray_error_handler(e)(e)
+
+
+def _log_and_wrap(
+    message: str, result_type: Callable[[Exception], _TpuRunResult]
+) -> Callable[[RayError], _TpuRunResult]:
+    def handler(e: RayError) -> _TpuRunResult:
+        logger.exception(message, exc_info=e)
+        return result_type(e)
+
+    return handler
+
+
+def _handle_task_error(e: RayError) -> _TpuRunResult:
+    assert isinstance(e, RayTaskError)
+    # node preemptions don't always show up as one of the above errors and can just be a RayTaskError. We have
+    # to try to sniff out the TPU's status.
+    if _cached_is_preempted():
+        logger.exception("Preempted", exc_info=e)
         return TpuPreempted(e)
-    elif isinstance(e, WorkerCrashedError):
-        logger.exception("Worker crashed", exc_info=e)
+
+    # str(e) formats the whole remote traceback, so leave it to the logger to do only if the record is emitted
+    logger.exception("Task error %s", e, exc_info=e)
+    if _looks_like_timeout(e):
+        logger.exception("Timeout error. Assuming preempted", exc_info=e)
         return TpuPreempted(e)
-    elif isinstance(e, RaySystemError):
-        logger.exception("System error", exc_info=e)
-        return TpuRunError(e)
-    elif isinstance(e, RayTaskError):
-        # node preemptions don't always show up as one of the above errors and can just be a RayTaskError. We have
-        # to try to sniff out the TPU's status.
-        from levanter.infra.tpus import get_current_tpu_is_preempted
-
-        if get_current_tpu_is_preempted():
-            logger.exception("Preempted", exc_info=e)
-            return TpuPreempted(e)
-
-        logger.exception(f"Task error {e}", exc_info=e)
-        if isinstance(e.cause, TimeoutError) or "timed out" in str(e):
-            logger.exception("Timeout error. Assuming preempted", exc_info=e)
-            return TpuPreempted(e)
-        return TpuRunError(e)
+    return TpuRunError(e)
+
+
+def _looks_like_timeout(e: RayTaskError) -> bool:
+    """
+    Whether a task error looks like it was caused by a timeout. We look at the underlying cause and the exceptions it
+    was raised from or while handling, rather than `str(e)`, which formats the whole remote traceback.
+    """
+    seen: set[int] = set()
+    exc: BaseException | None = e.cause
+    while exc is not None and id(exc) not in seen:
+        if isinstance(exc, TimeoutError) or "timed out" in str(exc):
+            return True
+        seen.add(id(exc))
+        exc = exc.__cause__ or exc.__context__
+
+    # The cause may not have been deserialized, and its chain doesn't always survive the trip back from the worker,
+    # but the remote traceback has the messages of the whole chain.
+    remote_traceback = getattr(e, "traceback_str", None)
+    if remote_traceback is None:
+        # errors made by as_instanceof_cause don't keep the traceback, but their str() is precomputed from it
+        remote_traceback = str(e)
+    return "timed out" in remote_traceback
+
+
+# When many tasks fail at once (e.g. all hosts of a preempted slice), we only want to ask the metadata server once.
+_PREEMPTION_CHECK_TTL = 2.0  # seconds
+_preemption_check_lock = threading.Lock()
+_last_preemption_check: tuple[float, bool] | None = None  # (time.monotonic(), is_preempted)
+
+
+def _cached_is_preempted() -> bool:
+    """`get_current_tpu_is_preempted`, cached for a couple of seconds."""
+    global _last_preemption_check
+    last_check = _last_preemption_check
+    if last_check is not None and time.monotonic() - last_check[0] < _PREEMPTION_CHECK_TTL:
+        return last_check[1]
+
+    # If another thread is already checking, use the stale answer rather than piling on. If we don't have an
+    # answer yet, wait for theirs.
+    if not _preemption_check_lock.acquire(blocking=last_check is None):
+        return last_check[1]  # type: ignore
+
+    try:
+        last_check = _last_preemption_check
+        if last_check is not None and time.monotonic() - last_check[0] < _PREEMPTION_CHECK_TTL:
+            return last_check[1]
+
+        is_preempted = get_current_tpu_is_preempted()
+        _last_preemption_check = (time.monotonic(), is_preempted)
+        return is_preempted
+    finally:
+        _preemption_check_lock.release()
+
+
+_handle_unknown_error = _log_and_wrap("Unknown error", TpuRunError)
+
+
+# Checked in order, so more specific classifications must come before RayTaskError.
+_RAY_ERROR_HANDLERS: dict[type, Callable[[RayError], _TpuRunResult]] = {
+    # treat node failures as preemptions
+    NodeDiedError: _log_and_wrap("Node died", TpuPreempted),
+    ActorUnavailableError: _log_and_wrap("Actor died", TpuPreempted),
+    ActorDiedError: _log_and_wrap("Actor died", TpuPreempted),
+    WorkerCrashedError: _log_and_wrap("Worker crashed", TpuPreempted),
+    RaySystemError: _log_and_wrap("System error", TpuRunError),
+    RayTaskError: _handle_task_error,
+}
 
-    else:
-        logger.exception("Unknown error", exc_info=e)
-        return TpuRunError(e)
+
+def _ray_error_handler(e: RayError) -> Callable[[RayError], _TpuRunResult]:
+    # Ray wraps remote failures in classes created on the fly that derive from both RayTaskError and the cause's
+    # class (e.g. RayTaskError(ActorDiedError)), so we can't look up the exact type, and RayTaskError comes first in
+    # their MRO. Take the first matching entry in table order instead, which checks RayTaskError last.
+    for cls, handler in _RAY_ERROR_HANDLERS.items():
+        if isinstance(e, cls):
+            return handler
+    return _handle_unknown_error
 
 
 # @ray.remote
@@ -780,30 +1155,40 @@ def _handle_ray_error(e: RayError):
 #     for
 
 
-def run_on_pod_multislice(remote_fn: RemoteFunction | Callable, tpu_type: str, num_slices: int) -> list[ray.ObjectRef]:
+def run_on_pod_multislice(remote_fn: RemoteFunction | Callable, tpu_type: str, num_slices: int) -> list:
     """
     Run a remote function on multiple TPU slices.
 
+    Slices are waited on as they finish: as soon as one fails, the others are cancelled rather than run to completion.
+
     Args:
         remote_fn: A remote function that takes no arguments
         tpu_type: The type of TPU to run on, e.g. "v4-32"
         num_slices: The number of slices to run
 
     Returns:
-        A Ray ObjectRef that represents the result of the function
+        The results of the function, one per host (not ObjectRefs)
     """
-    return ray.get(
-        run_on_pod(remote_fn, tpu_type, num_slices=num_slices, max_retries_failure=0, max_retries_preemption=0)
+    return run_on_pod_resumable(
+        remote_fn, tpu_type, max_retries_preemption=0, max_retries_failure=0, num_slices=num_slices
     )
 
 
-def run_on_pod_resumable(remote_fn: RemoteFunction | Callable, tpu_type: str, max_retries_preemption: int = 1_000_000, max_retries_failure: int = 10):
+def run_on_pod_resumable(
+    remote_fn: RemoteFunction | Callable,
+    tpu_type: str,
+    max_retries_preemption: int = 1_000_000,
+    max_retries_failure: int = 10,
+    *,
+    num_slices: int = 1,
+):
     """
     Repeatedly run a function on a TPU pod until it succeeds or a maximum number of retries is reached.
 
     Args:
         remote_fn: A remote function that takes no arguments
         tpu_type: The type of TPU to run on, e.g. "v4-32"
+        num_slices: The number of slices to run
         max_retries_preemption: The maximum number of times to retry if the job is preempted
         max_retries_failure: The maximum number of times to retry if the job fails
 
@@ -814,40 +1199,40 @@ def run_on_pod_resumable(remote_fn: RemoteFunction | Callable, tpu_type: str, ma
     return run_on_pod(
         remote_fn,
         tpu_type,
-        num_slices=1,
+        num_slices=num_slices,
         max_retries_preemption=max_retries_preemption,
         max_retries_failure=max_retries_failure,
     )
 
 
+# deprecated in favor of run_on_pod_resumable(..., num_slices=n)
 def run_on_pod_multislice_resumable(
-    remote_fn: RemoteFunction | Callable, tpu_type: str, num_slices: int, max_retries_preemption: int = 1_000_000, max_retries_failure: int = 10
+    remote_fn: RemoteFunction | Callable,
+    tpu_type: str,
+    num_slices: int,
+    max_retries_preemption: int = 1_000_000,
+    max_retries_failure: int = 10,
 ):
     """
-    Repeatedly run a function on a TPU pod until it succeeds or a maximum number of retries is reached.
-
-    Args:
-        remote_fn: A remote function that takes no arguments
-        tpu_type: The type of TPU to run on, e.g. "v4-32"
-        num_slices: The number of slices to run
-        max_retries_preemption: The maximum number of times to retry if the job is preempted
-        max_retries_failure: The maximum number of times to retry if the job fails
-
-    Returns:
-        The result of the function (not an ObjectRef)
-
+    Deprecated. Use run_on_pod_resumable with num_slices instead.
     """
-    return run_on_pod(
+    warnings.warn(
+        "run_on_pod_multislice_resumable is deprecated in favor of run_on_pod_resumable(..., num_slices=n)",
+        DeprecationWarning,
+    )
+    return run_on_pod_resumable(
         remote_fn,
         tpu_type,
-        num_slices=num_slices,
         max_retries_preemption=max_retries_preemption,
         max_retries_failure=max_retries_failure,
+        num_slices=num_slices,
     )
 
 
-def _run_command(*args, **kwargs):
-    return subprocess.check_call(args, **kwargs)
+def _run_command(*args, **kwargs) -> int:
+    # close_fds stays on: the docker client runs for the whole workload and shouldn't hold on to the Ray worker's
+    # sockets. CPython closes them with close_range() where available rather than scanning /proc/self/fd.
+    return subprocess.run(args, check=True, **kwargs).returncode
 
 
 def run_docker_on_pod(
@@ -856,14 +1241,12 @@ def run_docker_on_pod(
     env = _massage_env(env)
 
     docker_cmd = make_docker_run_command(image_id, command, env=env, foreground=True, name=name)
+    # The command (which includes the whole env) goes into the object store once, so the function shipped on every
+    # retry only carries a reference to it.
+    docker_cmd_ref = ray.put(tuple(docker_cmd))
 
     def run_docker():
-        _kill_old_container(name)
-        try:
-            return _run_command(*docker_cmd)
-        except subprocess.CalledProcessError as e:
-            logger.exception("Failed to run docker command")
-            raise e
+        return _run_docker_task(docker_cmd_ref, name)
 
     run_on_pod(
         ray.remote(max_calls=1)(run_docker),
@@ -871,46 +1254,110 @@ def run_docker_on_pod(
         num_slices=num_slices,
         max_retries_failure=retries,
         max_retries_preemption=10000,
+        # docker already isolates the workload, so the fresh worker from max_calls=1 is plenty
+        isolate="worker",
     )
 
 
-def _kill_old_container(name):
+def _run_docker_task(docker_cmd_ref: ray.ObjectRef, name: str):
+    kill_proc = _start_kill_old_container(name)
+    docker_cmd = ray.get(docker_cmd_ref)
+    # the kill is only waited on right before the new container needs the name
+    kill_proc.wait()
     try:
-        logger.info(f"Killing old container {name}")
-        _run_command("sudo", "docker", "rm", "-f", name)
-    except subprocess.CalledProcessError:
-        pass
+        return _run_command(*docker_cmd)
+    except subprocess.CalledProcessError as e:
+        logger.exception("Failed to run docker command")
+        raise e
+
+
+def _start_kill_old_container(name) -> subprocess.Popen:
+    """
+    Start removing any old container with this name without waiting for it. `docker rm -f` kills the container
+    outright (no graceful-stop timeout), and a missing container is not an error, so the exit code is ignored.
+    """
+    logger.info(f"Killing old container {name}")
+    return subprocess.Popen(["sudo", "docker", "rm", "-f", name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+
+# Subprocesses are started from a forkserver rather than forked from the (heavy, possibly TPU-holding) Ray worker or
+# spawned from scratch. The forkserver preloads the modules most workloads need, so each launch is a cheap fork.
+_MP_CTX = multiprocessing.get_context("forkserver")
+_FORKSERVER_PRELOAD = ["levanter.infra.tpus", "jax", "numpy"]
+_forkserver_preload_set = False
 
 
+def _get_mp_context():
+    global _forkserver_preload_set
+    if not _forkserver_preload_set:
+        # this has to happen before the forkserver is started, i.e. before the first process is launched
+        _MP_CTX.set_forkserver_preload(_FORKSERVER_PRELOAD)
+        _forkserver_preload_set = True
+    return _MP_CTX
+
+
+def _separate_process_target(conn, pickled_fn: bytes, args, kwargs):
+    """
+    Entry point of the subprocess started by _separate_process_fn. The function is cloudpickled because the
+    forkserver start method can only pass along objects that the standard pickle can handle.
+    """
+    try:
+        # Call the original function
+        underlying_function = cloudpickle.loads(pickled_fn)
+        result = underlying_function(*args, **kwargs)
+        conn.send((True, result))  # Success, send the result
+    except Exception as e:
+        # Capture and return the full traceback in case of an exception
+        info = ser_exc_info(e)
+        conn.send((False, info))
+    finally:
+        conn.close()
+
+
+def _forkify_remote_fn(remote_fn: RemoteFunction) -> RemoteFunction:
+    """
+    Wrap a remote function so that its body runs in a separate process (see `_separate_process_fn`).
+
+    Ray tasks with max_calls=1 already get a fresh worker, but some state (e.g. the libtpu lockfile or
+    jax.distributed's one-init-per-process rule) can still leak between runs within a worker.
+    """
+    fn = remote_fn._function
+
+    @functools.wraps(fn)
+    def wrapped_fn(*args, **kwargs):
+        return _separate_process_fn(fn, args, kwargs)
+
+    return ray.remote(**remote_fn._default_options)(wrapped_fn)
+
 
 def _separate_process_fn(underlying_function, args, kwargs):
     """
     Helper function for _forkify_remote_fn. This runs the function in a separate process.
     """
+    ctx = _get_mp_context()
+    # A one-shot pipe is all we need to get a single result back; a Queue would also spin up a feeder thread.
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(
+        target=_separate_process_target, args=(child_conn, cloudpickle.dumps(underlying_function), args, kwargs)
+    )
+    process.start()
+    # Close our copy of the child's end so that recv() raises EOFError if the child dies without sending anything.
+    child_conn.close()
 
-    def target_fn(queue, args, kwargs):
-        try:
-            # Call the original function
-            result = underlying_function(*args, **kwargs)
-            queue.put((True, result))  # Success, put the result
-        except Exception as e:
-            # Capture and return the full traceback in case of an exception
-            info = ser_exc_info(e)
-            queue.put((False, info))
+    # Receive before joining: a large result won't fit in the pipe's buffer, so the child can't exit until we read it.
+    try:
+        success, value = parent_conn.recv()
+    except EOFError:
+        process.join()
+        logger.error(f"Process exited with code {process.exitcode} without returning a result")
+        # historically reported as a timeout, which we treat as a preemption
+        raise TimeoutError("Process exited without returning a result")
+    finally:
+        parent_conn.close()
 
-    queue = multiprocessing.Queue()
-    process = multiprocessing.Process(target=target_fn, args=(queue, args, kwargs))
-    process.start()
     process.join()
-
-    # Retrieve the result or error from the queue
     logger.info("Process finished")
-    try:
-        success, value = queue.get(timeout=1)
-    except QueueEmpty:
-        logger.error("Process timed out")
-        process.terminate()
-        raise TimeoutError("Process timed out")
 
     if success:
         return value
@@ -918,6 +1365,9 @@ def _separate_process_fn(underlying_function, args, kwargs):
         value.reraise()
 
 
+_LIBTPU_LOCKFILE = "/tmp/libtpu_lockfile"
+
+
 def _hacky_remove_tpu_lockfile():
     """
     This is a hack to remove the lockfile that TPU pods create on the host filesystem.
@@ -928,17 +1378,17 @@ def _hacky_remove_tpu_lockfile():
     persists across Ray tasks. This doesn't apply to our docker-based workloads, but it does apply to other
     tasks that use JAX directly.
     """
-    if os.path.exists("/tmp/libtpu_lockfile"):
+    try:
+        os.unlink(_LIBTPU_LOCKFILE)
+    except FileNotFoundError:
+        pass
+    except PermissionError:
+        logger.warning("Failed to remove lockfile, retrying with sudo")
         try:
-            os.unlink("/tmp/libtpu_lockfile")
-        except FileNotFoundError:
-            pass
-        except PermissionError:
-            logger.warning("Failed to remove lockfile")
-            try:
-                os.system("sudo rm /tmp/libtpu_lockfile")
-            except Exception:  # noqa
-                pass
+            # -n: fail instead of prompting for a password. No shell in between, so this is a single exec.
+            subprocess.run(["sudo", "-n", "rm", "-f", _LIBTPU_LOCKFILE], check=False, timeout=5)
+        except Exception as e:  # noqa
+            logger.debug(f"Failed to remove lockfile with sudo: {e}")
 
 
 @dataclass
@@ -960,39 +1410,50 @@ def submit_tpu_job_on_ray(config: RunDockerOnPodConfig, ray_address: str, run_id
     If run_id is not provided, a default run ID will be generated.
     """
 
-    with tempfile.NamedTemporaryFile(suffix=".yaml", prefix=f"launch-{run_id}-", dir=".") as f:
+    # Only the launch config and the levanter package are uploaded, rather than the whole current directory. The
+    # config travels as a file rather than on the command line because its env holds secrets (e.g. WANDB_API_KEY),
+    # and the entrypoint shows up in `ray job list`, the dashboard, and `ps` on the head node.
+    os.makedirs(_LAUNCH_CONFIG_DIR, exist_ok=True)
+    config_name = f"launch-{run_id or time.time_ns()}.yaml"
+    config_path = os.path.join(_LAUNCH_CONFIG_DIR, config_name)
+
+    with tempfile.NamedTemporaryFile(suffix=".yaml", dir=_LAUNCH_CONFIG_DIR, delete=False) as f:
         yaml = draccus.dump(config)
         f.write(yaml.encode("utf-8"))
-        f.flush()
+    os.replace(f.name, config_path)
 
-        f_name = os.path.relpath(f.name)
-        logger.info(f"Submitting job with config path {f_name}")
+    logger.info(f"Submitting job with config path {config_path}")
 
-        client = JobSubmissionClient(ray_address)
+    client = JobSubmissionClient(ray_address)
 
-        job_id = _make_unique_job_id(client, run_id) if run_id is not None else None
+    return _submit_job_with_unique_id(
+        client,
+        run_id,
+        entrypoint=f"python -m levanter.infra.ray_tpu --config_path {config_name}",
+        runtime_env={"working_dir": _LAUNCH_CONFIG_DIR, "py_modules": [_levanter_package_dir()]},
+    )
 
-        job_id = client.submit_job(
-            entrypoint=f"python -m levanter.infra.ray_tpu --config_path {f_name}",
-            runtime_env={"working_dir": ".", "env_vars": {"PYTHONPATH": "src:."}},
-            submission_id=job_id,
-        )
 
-        return job_id
+_LAUNCH_CONFIG_DIR = ".ray_launch_configs"
+
+
+def _levanter_package_dir() -> str:
+    import levanter
+
+    return os.path.dirname(os.path.abspath(levanter.__file__))
 
 
 # try to make the job id be the same as the run id, but if it already exists, just make it unique
-def _make_unique_job_id(client, run_id):
-    job_id = run_id
+def _submit_job_with_unique_id(client, run_id: Optional[str], **kwargs):
     try:
-        while client.get_job_status(job_id) is not None:
-            job_id = f"{run_id}-{time.time_ns()}"
+        return client.submit_job(submission_id=run_id, **kwargs)
     except Exception as e:  # noqa
-        if "does not exist" in str(e):
-            pass
-        else:
+        if run_id is None or "already exists" not in str(e):
             raise
-    return job_id
+
+    job_id = f"{run_id}-{uuid.uuid4().hex[:8]}"
+    logger.info(f"Job {run_id} already exists, submitting as {job_id}")
+    return client.submit_job(submission_id=job_id, **kwargs)
 
 
 @draccus.wrap()
@@ -1027,15 +1488,8 @@ def _massage_env(env):
     # Ray pretends it's running in a TTY, which leads to a ton of log spam from tqdm.
     # Levanter uses tqdm_loggable, which tries to sniff out the TTY, but it doesn't work with Ray.
     # So we force it
-    env = dict(env)
-    if "TERM" not in env:
-        env["TERM"] = "dumb"
-
-    if "TF_CPP_MIN_LOG_LEVEL" not in env:
-        # Suppress TensorFlow logs, which can be very verbose
-        env["TF_CPP_MIN_LOG_LEVEL"] = "3"
-
-    return env
+    # We also suppress TensorFlow logs, which can be very verbose. Values set by the caller win.
+    return {"TERM": "dumb", "TF_CPP_MIN_LOG_LEVEL": "3", **env}
 
 
 if __name__ == "__main__":
@@ -1,9 +1,10 @@
 import functools
+import importlib.util
 import math
 import warnings
 from dataclasses import dataclass
 from enum import Enum
-from typing import Optional, Union, overload
+from typing import Callable, NamedTuple, Optional, Union, overload
 
 import equinox as eqx
 import jax
@@ -18,7 +19,7 @@ import haliax
 import haliax as hax
 import haliax.nn as hnn
 from haliax import Axis, AxisSelection, AxisSelector, NamedArray, axis_name
-from haliax.jax_utils import maybe_rng_split, named_call
+from haliax.jax_utils import named_call
 from haliax.nn.attention import causal_mask, combine_masks_and, combine_masks_or
 from haliax.nn.normalization import LayerNormBase
 from haliax.partitioning import pspec_for_axis
@@ -103,6 +104,87 @@ def dot_product_attention(
     if axis_name(QPos) == axis_name(KPos):
         raise ValueError("QPos and KPos must have different names")
 
+    qlen = query.axis_size(QPos)
+    klen = key.axis_size(KPos)
+    attn_backend, was_default = _resolve_backend(use_flash, attn_backend, qlen, klen, flash_block_size)
+
+    if scaling_factor is None:
+        scaling_factor = 1 / math.sqrt(query.resolve_axis(Key).size)
+
+    if dropout == 0.0 or inference:
+        # no backend needs randomness, so don't thread the key through them at all
+        prng = None
+
+    if klen == 1 and bias is None and prng is None and _single_key_is_always_visible(mask):
+        # softmax over a single visible key is exactly 1, so there's nothing for a kernel to do
+        out_axes = _attention_output_axes(query.axes, key.axes, value.axes, axis_name(KPos), axis_name(Key))
+        return hax.broadcast_to(value[KPos, 0], out_axes).astype(query.dtype)
+
+    attention_out = _BACKEND_IMPLS[attn_backend](
+        QPos,
+        KPos,
+        Key,
+        query,
+        key,
+        value,
+        mask,
+        bias,
+        dropout=dropout,
+        inference=inference,
+        force=not was_default,
+        prng=prng,
+        attention_dtype=attention_dtype,
+        precision=precision,
+        flash_block_size=flash_block_size,
+        scaling_factor=scaling_factor,
+        logits_soft_cap=logits_soft_cap,
+    )
+
+    if attention_out is not None:
+        return attention_out
+    else:
+        # the chosen backend couldn't handle these arguments and asked us to fall back
+        return _jax_flash_backend(
+            QPos,
+            KPos,
+            Key,
+            query,
+            key,
+            value,
+            mask,
+            bias,
+            dropout=dropout,
+            inference=inference,
+            force=False,
+            prng=prng,
+            attention_dtype=attention_dtype,
+            precision=precision,
+            flash_block_size=flash_block_size,
+            scaling_factor=scaling_factor,
+            logits_soft_cap=logits_soft_cap,
+        )
+
+
+def _single_key_is_always_visible(mask: Optional[Union[NamedArray, "AttentionMask"]]) -> bool:
+    """Whether every query can see the (only) key at position 0 under this mask."""
+    if mask is None:
+        return True
+    # causal masks always let every query see key 0. Anything data-dependent we leave to the backends.
+    return isinstance(mask, AttentionMask) and mask.explicit_mask is None and mask.segment_ids is None
+
+
+@functools.lru_cache(maxsize=None)
+def _resolve_backend(
+    use_flash: Optional[bool],
+    attn_backend: Optional[AttentionBackend],
+    qlen: int,
+    klen: int,
+    flash_block_size: Optional[int],
+) -> tuple[AttentionBackend, bool]:
+    """
+    Works out which backend to use for dot_product_attention. Returns the backend and whether it was chosen by
+    default (in which case backends that can't handle the arguments fall back rather than raise).
+    """
     if use_flash is not None:
         if attn_backend is None:
             if not use_flash:
@@ -114,110 +196,76 @@ def dot_product_attention(
                 raise ValueError("use_flash is False, but flash_backend is not VANILLA")
             elif attn_backend == AttentionBackend.VANILLA and use_flash:
                 raise ValueError("use_flash is True, but flash_backend is VANILLA")
-    elif use_flash is None and attn_backend is None:
+    elif attn_backend is None:
         # if the block_size doesn't divide the seq lens, we can't use flash. Previously default was use_flash=False
         if flash_block_size is not None:
-            qlen = query.axis_size(QPos)
-            klen = key.axis_size(KPos)
             if qlen % flash_block_size != 0 or klen % flash_block_size != 0:
-                use_flash = False
                 attn_backend = AttentionBackend.VANILLA
 
     if attn_backend is None or attn_backend == AttentionBackend.DEFAULT:
-        was_default = True
-        attn_backend = default_attention_type()
+        return default_attention_type(), True
     else:
-        was_default = False
+        return attn_backend, False
 
-    if scaling_factor is None:
-        scaling_factor = 1 / math.sqrt(query.resolve_axis(Key).size)
 
-    match attn_backend:
-        case AttentionBackend.NVTE:
-            attention_out = _try_te_attention(
-                QPos,
-                KPos,
-                Key,
-                query,
-                key,
-                value,
-                mask,
-                bias,
-                dropout,
-                inference,
-                prng=prng,
-                attention_dtype=attention_dtype,
-                precision=precision,
-                flash_block_size=flash_block_size,
-                force_te=not was_default,
-                scaling_factor=scaling_factor,
-                logits_soft_cap=logits_soft_cap,
-            )
-        case AttentionBackend.SPLASH:
-            attention_out = _try_tpu_splash_attention(
-                QPos,
-                KPos,
-                Key,
-                query,
-                key,
-                value,
-                mask,
-                bias,
-                dropout,
-                inference,
-                force_flash=not was_default,
-                prng=prng,
-                attention_dtype=attention_dtype,
-                precision=precision,
-                block_size=flash_block_size,
-                scaling_factor=scaling_factor,
-                logits_soft_cap=logits_soft_cap,
-            )
-        case AttentionBackend.VANILLA:
-            attention_out = simple_attention_with_dropout(
-                QPos,
-                KPos,
-                Key,
-                query,
-                key,
-                value,
-                mask,
-                bias,
-                inference,
-                dropout,
-                attention_dtype,
-                precision,
-                prng=prng,
-                scaling_factor=scaling_factor,
-                logits_soft_cap=logits_soft_cap,
-            )
-        case _:
-            attention_out = None
+# The backends all take (QPos, KPos, Key, query, key, value, mask, bias) followed by the keyword arguments of
+# dot_product_attention, plus `force`: whether to raise rather than return None when the backend can't handle the
+# arguments.
 
-    if attention_out is not None:
-        return attention_out
-    else:
-        # local import to avoid circular imports
-        from levanter.models.flash_attention import flash_attention
 
-        return flash_attention(
-            QPos,
-            KPos,
-            Key,
-            query,
-            key,
-            value,
-            block_size=flash_block_size,
-            mask=mask,
-            bias=bias,
-            dropout=dropout,
-            inference=inference,
-            key=prng,
-            dtype=attention_dtype,
-            precision=precision,
-            scaling_factor=scaling_factor,
-            logits_soft_cap=logits_soft_cap,
-        )
+def _te_backend(*args, force, flash_block_size, **kwargs) -> Optional[NamedArray]:
+    return _try_te_attention(*args, force_te=force, flash_block_size=flash_block_size, **kwargs)
+
+
+def _splash_backend(*args, force, flash_block_size, **kwargs) -> Optional[NamedArray]:
+    return _try_tpu_splash_attention(*args, force_flash=force, block_size=flash_block_size, **kwargs)
+
+
+def _vanilla_backend(*args, force, flash_block_size, **kwargs) -> Optional[NamedArray]:
+    return simple_attention_with_dropout(*args, **kwargs)
+
+
+def _jax_flash_backend(
+    QPos,
+    KPos,
+    Key,
+    query,
+    key,
+    value,
+    mask,
+    bias,
+    *,
+    force,
+    dropout,
+    inference,
+    prng,
+    attention_dtype,
+    precision,
+    flash_block_size,
+    scaling_factor,
+    logits_soft_cap,
+) -> NamedArray:
+    # local import to avoid circular imports
+    from levanter.models.flash_attention import flash_attention
+
+    return flash_attention(
+        QPos,
+        KPos,
+        Key,
+        query,
+        key,
+        value,
+        block_size=flash_block_size,
+        mask=mask,
+        bias=bias,
+        dropout=dropout,
+        inference=inference,
+        key=prng,
+        dtype=attention_dtype,
+        precision=precision,
+        scaling_factor=scaling_factor,
+        logits_soft_cap=logits_soft_cap,
+    )
 
 
 def simple_attention_with_dropout(
@@ -238,38 +286,53 @@ def simple_attention_with_dropout(
     scaling_factor: float | None = None,
     logits_soft_cap: Optional[float] = None,
 ):
+    """
+    Reference (unfused) dot product attention that materializes the full attention logits. This is the VANILLA
+    backend and the fallback for the other backends. Tiled, online-softmax attention is provided by the other
+    backends: Splash on TPU, TE on GPU, and [levanter.models.flash_attention.flash_attention][] elsewhere.
+    """
     QPos = query.resolve_axis(QPos)
     KPos = key.resolve_axis(KPos)
     m = materialize_mask(mask, QPos, KPos)
     orig_dtype = query.dtype
 
     if scaling_factor is None:
-        scaling_factor = 1.0 / jnp.sqrt(query.axis_size(Key))
-
-    query = query * scaling_factor
+        scaling_factor = 1.0 / math.sqrt(query.axis_size(Key))
 
     if attention_dtype is not None:
         query = query.astype(attention_dtype)
         key = key.astype(attention_dtype)
 
-    weights = haliax.dot(query, key, precision=precision, axis=Key)
+    # Scaling the logits rather than the query lets XLA fuse the multiply with the elementwise ops below, instead of
+    # spending a separate pass over the query.
+    weights = haliax.dot(query, key, precision=precision, axis=Key) * scaling_factor
 
     if bias is not None:
         weights = weights + bias
 
+    # soft-cap before masking, so the masked fill value doesn't go through the tanh
     if logits_soft_cap is not None:
-        weights = hax.tanh(weights / logits_soft_cap) * logits_soft_cap
+        weights = hax.tanh(weights * (1.0 / logits_soft_cap)) * logits_soft_cap
 
     if m is not None:
-        weights = haliax.where(m, weights, -1e9)
+        # the dtype's own minimum rather than -1e9, which is out of range for fp16 and would make XLA promote the
+        # select. Not -inf: a fully masked row would then softmax to NaN.
+        weights = haliax.where(m, weights, jnp.finfo(weights.dtype).min)
 
     weights = haliax.nn.softmax(weights, axis=KPos)
 
-    weights = weights.astype(orig_dtype)
+    if dropout != 0.0 and not inference:
+        weights = haliax.nn.dropout(weights, dropout, key=prng, inference=inference)
 
-    out = haliax.nn.dropout(weights, dropout, key=prng, inference=inference)
+    # Do the PV matmul in the narrower of the two dtypes. If the attention dtype is the narrower one, cast the (much
+    # smaller) value rather than the weights, which saves a full pass over the weights. Otherwise (e.g. upcast_attn)
+    # bring the weights back down to the value's dtype, as before.
+    if jnp.dtype(weights.dtype).itemsize < jnp.dtype(value.dtype).itemsize:
+        value = value.astype(weights.dtype)
+    else:
+        weights = weights.astype(value.dtype)
 
-    return haliax.dot(out, value, axis=KPos)
+    return haliax.dot(weights, value, axis=KPos, preferred_element_type=orig_dtype)
 
 
 def _try_te_attention(
@@ -293,6 +356,9 @@ def _try_te_attention(
     logits_soft_cap: Optional[float] = None,
 ):
     try:
+        if not _has_transformer_engine():
+            # don't retry (and re-scan sys.path for) a failed import on every trace
+            raise ImportError("No module named 'transformer_engine'")
         return _te_flash_attention(
             QPos,
             KPos,
@@ -349,6 +415,11 @@ def _try_te_attention(
         return None
 
 
+@functools.cache
+def _has_transformer_engine() -> bool:
+    return importlib.util.find_spec("transformer_engine") is not None
+
+
 def _te_flash_attention(
     QPos: AxisSelector,
     KPos: AxisSelection,
@@ -404,13 +475,16 @@ def _te_flash_attention(
         raise ValueError("k and v must have the same axes")
 
     if B != Bk:
-        raise ValueError(f"Batch axes must be the same for q, k, and v: {q_class['B']} != {k_class['B']}")
+        raise ValueError(f"Batch axes must be the same for q, k, and v: {q_class.B} != {k_class.B}")
 
     if D != Dk:
-        raise ValueError(f"Embedding axes must be the same for q, k, and v: {q_class['D']} != {k_class['D']}")
+        raise ValueError(f"Embedding axes must be the same for q, k, and v: {q_class.D} != {k_class.D}")
+
+    if Hq % Hk != 0:
+        raise ValueError(f"Query heads must be a multiple of kv heads: {q_class.H} vs {k_class.H}")
 
     # Mask is generated by transformer engine based on AttnMaskType
-    attn_mask_type, fused_attn_mask = _te_materialize_mask(KPos, QPos, B, mask)
+    attn_mask_type, fused_attn_mask = _te_materialize_mask(mask)
 
     is_training = not inference
 
@@ -420,18 +494,44 @@ def _te_flash_attention(
     if bias:
         raise NotImplementedError("Using bias with flash attention on GPU is not currently implemented.")
 
-    attn_output = fused_attn(
-        qkv=(q_, k_, v_),
-        bias=fused_attn_bias,
-        mask=fused_attn_mask,
-        seed=prng,
-        attn_bias_type=attn_bias_type,
-        attn_mask_type=attn_mask_type,
-        qkv_layout=QKVLayout.BSHD_BSHD_BSHD,
-        scaling_factor=scaling_factor,
-        dropout_probability=dropout,
-        is_training=is_training,
-    )
+    def _fused_attn(q_, k_, v_, seed=prng):
+        return fused_attn(
+            qkv=(q_, k_, v_),
+            bias=fused_attn_bias,
+            mask=fused_attn_mask,
+            seed=seed,
+            attn_bias_type=attn_bias_type,
+            attn_mask_type=attn_mask_type,
+            qkv_layout=QKVLayout.BSHD_BSHD_BSHD,
+            scaling_factor=scaling_factor,
+            dropout_probability=dropout,
+            is_training=is_training,
+        )
+
+    mesh = haliax.partitioning._get_mesh()
+    if mesh.empty:
+        attn_output = _fused_attn(q_, k_, v_)
+    else:
+        # Run the kernel on each device's shard, as we do for splash, so q/k/v aren't gathered at the kernel boundary
+        physical_axes_q = _physical_axes_for_bins(q_class, "BSHD")
+        physical_axes_k = _physical_axes_for_bins(k_class, "BSHD")
+        physical_axes_v = _physical_axes_for_bins(v_class, "BSHD")
+
+        def _fused_attn_on_shard(q_, k_, v_):
+            # every shard sees the same closed-over prng, so give each one its own key or they'd all drop out the
+            # same positions of their slice of the batch
+            seed = prng
+            if seed is not None and dropout > 0.0:
+                seed = _fold_in_shard_index(seed, physical_axes_q)
+            return _fused_attn(q_, k_, v_, seed)
+
+        attn_output = shard_map(
+            _fused_attn_on_shard,
+            mesh=mesh,
+            in_specs=(physical_axes_q, physical_axes_k, physical_axes_v),
+            out_specs=physical_axes_q,
+            check_rep=False,
+        )(q_, k_, v_)
 
     # per the NVTE code, the output is BSHD. we can reshape it to match our axes
     # we have to ungroup the axes, then reshape them to match our expected output
@@ -442,28 +542,13 @@ def _te_flash_attention(
     # we can reshape it to match our expected output
     attn_output = _unflatten_bshd(attn_output, q_class, v_class)
 
-    reference_out_shape = eqx.filter_eval_shape(
-        simple_attention_with_dropout,
-        QPos,
-        KPos,
-        Key,
-        query,
-        key,
-        value,
-        mask,
-        bias,
-        inference,
-        dropout,
-        attention_dtype,
-        precision,
-        prng=prng,
-    )
-    attn_output = attn_output.rearrange(reference_out_shape.axes).astype(reference_out_shape.dtype)
+    out_axes = _attention_output_axes(query.axes, key.axes, value.axes, KPos.name, axis_name(Key))
+    attn_output = attn_output.rearrange(out_axes).astype(attention_dtype)
 
     return attn_output
 
 
-def _te_materialize_mask(KPos, QPos, batch_size, mask):
+def _te_materialize_mask(mask):
     from transformer_engine.jax.attention import AttnMaskType
 
     if isinstance(mask, NamedArray):
@@ -471,25 +556,16 @@ def _te_materialize_mask(KPos, QPos, batch_size, mask):
             "Custom NamedArray masks are not implemented for flash attention. Please pass an AttentionMask object"
         )
     elif isinstance(mask, AttentionMask):
-        if mask.causal():
+        if mask.is_causal and mask.explicit_mask is None and mask.segment_ids is None:
+            # TE builds the causal mask itself from attn_mask_type and ignores the mask array for CAUSAL_MASK and
+            # NO_MASK, so we don't materialize a (B, Q, K) array that would never be read.
             attn_mask_type = AttnMaskType.CAUSAL_MASK
-
-            fused_attn_mask = mask.materialize(QPos, KPos)
-
-            assert (
-                fused_attn_mask is not None
-            ), "If AttentionMask is causal, the materialized array should never be None. Something is wrong."
-
-            fused_attn_mask = fused_attn_mask.array
-            fused_attn_mask = jnp.dstack([fused_attn_mask] * batch_size)
-
+            fused_attn_mask = None
         else:
-            raise NotImplementedError(
-                "Non-Causal masks are not implemented for flash attention. Please pass an AttentionMask object"
-            )
+            raise NotImplementedError("Only purely causal AttentionMasks are implemented for flash attention on GPU.")
     else:
         attn_mask_type = AttnMaskType.NO_MASK
-        fused_attn_mask = jnp.ones((batch_size, QPos.size, KPos.size))
+        fused_attn_mask = None
     return attn_mask_type, fused_attn_mask
 
 
@@ -497,7 +573,16 @@ _DUMMY_HEAD = "__head__"
 _DUMMY_BATCH = "__batch__"
 
 
-def _bin_and_group_axes_by_function(q, k, v, QPos, KPos, Key):
+class _AxisBins(NamedTuple):
+    """The axes of one of q, k, or v, grouped by their role in the BSHD layout."""
+
+    B: tuple[Axis, ...]
+    S: tuple[Axis, ...]
+    H: tuple[Axis, ...]
+    D: tuple[Axis, ...]
+
+
+def _bin_and_group_axes_by_function(q, k, v, QPos, KPos, Key) -> tuple[_AxisBins, _AxisBins, _AxisBins]:
     """
     NVTE and the Splash Attention kernel require the Q, K, and V to be in a specific format. This function groups the axes
     of Q, K, and V into the right bins to match that format.
@@ -520,16 +605,29 @@ def _bin_and_group_axes_by_function(q, k, v, QPos, KPos, Key):
     - If there are any other axes present in one but not all three, it's an error
      (TODO: we could vmap over these?)
     """
-    QPos = q.resolve_axis(QPos)
-    KPos = k.resolve_axis(KPos)
-    Key = q.resolve_axis(Key)
-
-    q_class = {"B": [], "S": [QPos], "H": [], "D": [Key]}
-    k_class = {"B": [], "S": [KPos], "H": [], "D": [Key]}
-    v_class = {"B": [], "S": [KPos], "H": [], "D": [Key]}
-
-    present_in_all: set[str] = q.shape.keys() & k.shape.keys() & v.shape.keys()
-    spoken_for: set[str] = {QPos.name, KPos.name, Key.name}
+    # this only depends on the axes, so it's computed once per model config rather than on every trace
+    return _bin_axes_by_function(q.axes, k.axes, v.axes, axis_name(QPos), axis_name(KPos), axis_name(Key))
+
+
+@functools.lru_cache(maxsize=None)
+def _bin_axes_by_function(
+    q_axes: tuple[Axis, ...],
+    k_axes: tuple[Axis, ...],
+    v_axes: tuple[Axis, ...],
+    q_pos: str,
+    k_pos: str,
+    key: str,
+) -> tuple[_AxisBins, _AxisBins, _AxisBins]:
+    q_by_name = {ax.name: ax for ax in q_axes}
+    k_names = frozenset(ax.name for ax in k_axes)
+    v_names = frozenset(ax.name for ax in v_axes)
+
+    QPos = q_by_name[q_pos]
+    KPos = next(ax for ax in k_axes if ax.name == k_pos)
+    Key = q_by_name[key]
+
+    present_in_all = q_by_name.keys() & k_names & v_names
+    spoken_for = {q_pos, k_pos, key}
 
     # find the primary H axes: which are axes that are:
     # - present in all three
@@ -537,7 +635,7 @@ def _bin_and_group_axes_by_function(q, k, v, QPos, KPos, Key):
     # - come after QPos in Q (if there's already a primary H)
     # - not the 0th axis in Q (even if there's no primary H)
     primary_H: list[Axis] = []
-    for a in reversed(q.axes[1:]):
+    for a in reversed(q_axes[1:]):
         if a.name in present_in_all and a.name not in spoken_for:
             primary_H.append(a)
         elif a == QPos and primary_H:  # better to always have at least one H?
@@ -546,64 +644,125 @@ def _bin_and_group_axes_by_function(q, k, v, QPos, KPos, Key):
     # since we added them in reverse order, we need to reverse them
     primary_H.reverse()
 
-    spoken_for.update([ax.name for ax in primary_H])
+    spoken_for.update(ax.name for ax in primary_H)
 
     # remaining shared axes are batch axes
-    batch_axes = [ax for ax in q.axes if ax.name not in spoken_for and ax.name in present_in_all]
+    batch_axes = tuple(ax for ax in q_axes if ax.name not in spoken_for and ax.name in present_in_all)
 
-    spoken_for.update([ax.name for ax in batch_axes])
-
-    q_class["B"] = batch_axes
-    k_class["B"] = batch_axes
-    v_class["B"] = batch_axes
+    spoken_for.update(ax.name for ax in batch_axes)
 
     # if there's an axis in q that's not in k or v, it's an extra H for q
-    extra_q_H = [ax for ax in q.axes if ax.name not in spoken_for]
-
-    # we want primary_h to be *before* extra_q_H b/c GQA wants these to be minor axes
-    q_class["H"] = primary_H + extra_q_H
-    k_class["H"] = primary_H
-    v_class["H"] = primary_H
+    extra_q_H = tuple(ax for ax in q_axes if ax.name not in spoken_for)
 
     # now we want to detect any non-spoken-for axes. These are errors
     # eventually we can vmapp over these, but for now we'll just raise an error
-    for a in k.axes:
-        if a.name not in spoken_for:
-            raise ValueError(f"Axis {a.name} is present in k but not in q and/or v")
+    for name in k_names - spoken_for:
+        raise ValueError(f"Axis {name} is present in k but not in q and/or v")
+
+    for name in v_names - spoken_for:
+        raise ValueError(f"Axis {name} is present in v but not in q and/or k")
 
-    for a in v.axes:
-        if a.name not in spoken_for:
-            raise ValueError(f"Axis {a.name} is present in v but not in q and/or k")
+    # we want primary_h to be *before* extra_q_H b/c GQA wants these to be minor axes
+    q_class = _AxisBins(batch_axes, (QPos,), tuple(primary_H) + extra_q_H, (Key,))
+    kv_class = _AxisBins(batch_axes, (KPos,), tuple(primary_H), (Key,))
 
-    return q_class, k_class, v_class
+    return q_class, kv_class, kv_class
 
 
 def _reshape_axes_for_bshd_bins(q, q_class, output_order=("B", "S", "H", "D")):
     """
     Reshape the axes of a qkv as BSHD to match the bins in q_class
     """
+    perm, out_axes = _bshd_reshape_plan(q.axes, q_class, tuple(output_order))
+    out = jnp.transpose(q.array, perm).reshape(tuple(ax.size for ax in out_axes))
+    return haliax.named(out, out_axes)
 
-    def _maybe_flatten(q, axes, name):
-        if axes:
-            q = q.flatten_axes(axes, name)
-        else:
-            q = q.broadcast_axis(Axis(name, 1))
-        return q
 
-    q = _maybe_flatten(q, q_class["B"], "B")
-    q = _maybe_flatten(q, q_class["S"], "S")
-    q = _maybe_flatten(q, q_class["H"], "H")
-    q = _maybe_flatten(q, q_class["D"], "D")
-    q = q.rearrange(output_order)
-    return q
+@functools.lru_cache(maxsize=None)
+def _bshd_reshape_plan(
+    axes: tuple[Axis, ...], bins: _AxisBins, output_order: tuple[str, ...]
+) -> tuple[tuple[int, ...], tuple[Axis, ...]]:
+    """
+    The transpose (as a permutation of `axes`) and the resulting flattened axes that turn an array with `axes` into
+    one laid out as `output_order`. The binning is static, so this is a single transpose + reshape, worked out once.
+    """
+    index_of = {ax.name: i for i, ax in enumerate(axes)}
+    perm: list[int] = []
+    out_axes = []
+    for name in output_order:
+        group = getattr(bins, name)
+        perm.extend(index_of[ax.name] for ax in group)
+        # an empty bin becomes a dummy axis of size 1
+        out_axes.append(Axis(name, math.prod(axes[index_of[ax.name]].size for ax in group)))
+    return tuple(perm), tuple(out_axes)
 
 
 def _unflatten_bshd(attn_output, q_class, v_class):
-    attn_output = attn_output.unflatten_axis("B", q_class["B"])
-    attn_output = attn_output.unflatten_axis("S", q_class["S"])
-    attn_output = attn_output.unflatten_axis("H", q_class["H"])
-    attn_output = attn_output.unflatten_axis("D", v_class["D"])
-    return attn_output
+    out_axes = _unflatten_bshd_axes(attn_output.axes, q_class, v_class)
+    return haliax.named(attn_output.array.reshape(tuple(ax.size for ax in out_axes)), out_axes)
+
+
+@functools.lru_cache(maxsize=None)
+def _unflatten_bshd_axes(flat_axes: tuple[Axis, ...], q_class: _AxisBins, v_class: _AxisBins) -> tuple[Axis, ...]:
+    groups = {"B": q_class.B, "S": q_class.S, "H": q_class.H, "D": v_class.D}
+    return tuple(ax for flat in flat_axes for ax in groups[flat.name])
+
+
+def _physical_axes_for_bins(bins: _AxisBins, order: str) -> PartitionSpec:
+    """The PartitionSpec of a q/k/v that has been reshaped to `order` (e.g. "BSHD") by _reshape_axes_for_bshd_bins."""
+    mapping = haliax.partitioning.current_thread_local_mapping() or {}
+    # only the mapping of the axes we actually have matters, so key the cache on just those
+    relevant_mapping = tuple((ax.name, mapping.get(ax.name)) for group in bins for ax in group)
+    return _physical_axes_for_bins_cached(bins, order, relevant_mapping)
+
+
+@functools.lru_cache(maxsize=128)
+def _physical_axes_for_bins_cached(bins: _AxisBins, order: str, relevant_mapping: tuple) -> PartitionSpec:
+    mapping = dict(relevant_mapping)
+
+    def flatten(axes):
+        if axes is None:
+            return axes
+        result = []
+        for ax in axes:
+            if isinstance(ax, tuple):
+                result += list(ax)
+            else:
+                result.append(ax)
+        return tuple(result)
+
+    return PartitionSpec(
+        *(
+            flatten(tuple(ax for ax in pspec_for_axis(getattr(bins, name), mapping) if ax is not None) or None)
+            for name in order
+        )
+    )
+
+
+def _fold_in_shard_index(prng: PRNGKeyArray, spec: PartitionSpec) -> PRNGKeyArray:
+    """Inside a shard_map with `spec` as an in_spec, derives a key unique to this device's shard of the input."""
+    for mesh_axes in spec:
+        if isinstance(mesh_axes, str):
+            mesh_axes = (mesh_axes,)
+        for mesh_axis in mesh_axes or ():
+            prng = jax.random.fold_in(prng, jax.lax.axis_index(mesh_axis))
+    return prng
+
+
+@functools.lru_cache(maxsize=None)
+def _attention_output_axes(
+    q_axes: tuple[Axis, ...], k_axes: tuple[Axis, ...], v_axes: tuple[Axis, ...], k_pos: str, key: str
+) -> tuple[Axis, ...]:
+    """
+    The axes (in order) of the output of simple_attention_with_dropout for these inputs, i.e. the order that
+    `dot(dot(q, k, axis=Key), v, axis=KPos)` produces. Used so the fused kernels can match the reference's output.
+    """
+
+    def dot_axes(a_axes, b_axes, contracted):
+        a_names = {ax.name for ax in a_axes}
+        return tuple(ax for ax in a_axes + tuple(ax for ax in b_axes if ax.name not in a_names) if ax.name != contracted)
+
+    return dot_axes(dot_axes(q_axes, k_axes, key), v_axes, k_pos)
 
 
 def _materialize_segment_mask(segment_ids, QPos, KPos, q_slice, k_slice) -> NamedArray:
@@ -663,6 +822,8 @@ class AttentionMask(eqx.Module):
             k_slice = haliax.dslice(0, KPos.size)
 
         if self.is_causal:
+            # This is built from two iotas and a comparison, so XLA fuses it into whatever consumes the mask
+            # (e.g. the `where` in simple_attention_with_dropout) instead of writing a QxK array to memory.
             causal = causal_mask(QPos.resize(q_slice.size), KPos.resize(k_slice.size), q_slice.start, k_slice.start)
         else:
             causal = None
@@ -705,7 +866,10 @@ class AttentionMask(eqx.Module):
         return AttentionMask(is_causal=is_causal, explicit_mask=explicit_mask, segment_ids=segment_ids)
 
     def _check_for_same_segment_ids(self, other):
-        if self.segment_ids is not None and other.segment_ids is not None:
+        if self.segment_ids is other.segment_ids:
+            # the common case: both masks were built from the same segment ids, so there's nothing to compare
+            return self.segment_ids
+        elif self.segment_ids is not None and other.segment_ids is not None:
             # only one segment mask is allowed
             # b/c we might do this in jit, we use eqx.error_if
             # in theory we can do this one by just assigning unique ids to each unique pair...
@@ -864,8 +1028,6 @@ def _tpu_splash_attention(
     scaling_factor: float,
     logits_soft_cap: float | None = None,
 ) -> Optional[NamedArray]:
-    from jax.experimental.pallas.ops.tpu.splash_attention import splash_attention_kernel, splash_attention_mask
-
     # Splash attention requires BHSD format
     # We need to reshape the input to match this format
     if dropout != 0.0:
@@ -881,12 +1043,16 @@ def _tpu_splash_attention(
 
     q_class, k_class, v_class = _bin_and_group_axes_by_function(query, key, value, QPos, KPos, Key)
 
-    query = query * scaling_factor
-
     q_: jax.Array = _reshape_axes_for_bshd_bins(query, q_class, output_order=list("BHSD")).array
     k_ = _reshape_axes_for_bshd_bins(key, k_class, output_order=list("BHSD")).array
     v_ = _reshape_axes_for_bshd_bins(value, v_class, output_order=list("BHSD")).array
 
+    # cast outside the shard_map so XLA can fuse it with the transpose above
+    if attention_dtype is not None:
+        q_ = q_.astype(attention_dtype)
+        k_ = k_.astype(attention_dtype)
+        v_ = v_.astype(attention_dtype)
+
     B, Hq, Sq, D = q_.shape
     Bk, Hk, Sk, Dk = k_.shape
 
@@ -906,34 +1072,21 @@ def _tpu_splash_attention(
 
     # TODO: this isn't really necessary on TPU?
     if B != Bk:
-        raise ValueError(f"Batch axes must be the same for q, k, and v: {q_class['B']} != {k_class['B']}")
+        raise ValueError(f"Batch axes must be the same for q, k, and v: {q_class.B} != {k_class.B}")
 
     if D != Dk:
-        raise ValueError(f"Embedding axes must be the same for q, k, and v: {q_class['D']} != {k_class['D']}")
-
-    def _physical_axis_for_binning(d):
-        def flatten(axes):
-            if axes is None:
-                return axes
-            result = []
-            for ax in axes:
-                if isinstance(ax, tuple):
-                    result += list(ax)
-                else:
-                    result.append(ax)
-            return tuple(result)
-
-        b_out = flatten(tuple(ax for ax in pspec_for_axis(d["B"]) if ax is not None) or None)
-        h_out = flatten(tuple(ax for ax in pspec_for_axis(d["H"]) if ax is not None) or None)
-        s_out = flatten(tuple(ax for ax in pspec_for_axis(d["S"]) if ax is not None) or None)
-        d_out = flatten(tuple(ax for ax in pspec_for_axis(d["D"]) if ax is not None) or None)
-
-        return PartitionSpec(b_out, h_out, s_out, d_out)
+        raise ValueError(f"Embedding axes must be the same for q, k, and v: {q_class.D} != {k_class.D}")
+
+    # The kernel handles GQA natively: each kv head's blocks are loaded once and shared by its group of q heads,
+    # so we never repeat k/v. With a single kv head we use the dedicated MQA kernel.
+    if Hq % Hk != 0:
+        raise ValueError(f"Query heads must be a multiple of kv heads: {q_class.H} vs {k_class.H}")
+    is_mqa = Hk == 1 and Hq > 1
 
     # BHSD
-    physical_axes_q = _physical_axis_for_binning(q_class)
-    physical_axes_k = _physical_axis_for_binning(k_class)
-    physical_axes_v = _physical_axis_for_binning(v_class)
+    physical_axes_q = _physical_axes_for_bins(q_class, "BHSD")
+    physical_axes_k = _physical_axes_for_bins(k_class, "BHSD")
+    physical_axes_v = _physical_axes_for_bins(v_class, "BHSD")
 
     # segment_ids
     segment_ids = mask.segment_ids if isinstance(mask, AttentionMask) else None
@@ -953,12 +1106,34 @@ def _tpu_splash_attention(
     else:
         segment_batch_axis = None
 
+    if isinstance(mask, NamedArray):
+        raise NotImplementedError("NamedArray masks are not yet supported for splash attention")
+    elif isinstance(mask, AttentionMask):
+        # This is going to be a pain to support
+        if mask.explicit_mask is not None:
+            raise NotImplementedError("Explicit masks are not yet supported for splash attention")
+        is_causal = mask.is_causal
+    elif mask is None:
+        is_causal = False
+    else:
+        raise ValueError(f"Unknown mask type: {mask}")
+
     # MaxText uses a block size of 512
     block_size = block_size or 512
 
     # copied from MaxText
-    @functools.partial(
-        shard_map,
+    # check_rep stays off: the kernel's pallas_call out_shapes don't declare how they vary across the mesh, which
+    # shard_map's replication checking requires
+    wrap_flash_attention = shard_map(
+        functools.partial(
+            _splash_attention_on_shard,
+            block_size=block_size,
+            is_causal=is_causal,
+            logits_soft_cap=logits_soft_cap,
+            is_mqa=is_mqa,
+            scaling_factor=scaling_factor,
+            segment_batch_axis=segment_batch_axis,
+        ),
         mesh=haliax.partitioning._get_mesh(),
         in_specs=(
             physical_axes_q,
@@ -969,89 +1144,137 @@ def _tpu_splash_attention(
         out_specs=physical_axes_q,
         check_rep=False,
     )
-    def wrap_flash_attention(q, k, v, segment_ids):
-        # NB: inside the function, q, k, and v are partitioned, so in general the lengths of dims are not the same
-        Sq = q.shape[2]
-        Sk = k.shape[2]
-        Hq = q.shape[1]
-        block_sizes = splash_attention_kernel.BlockSizes(
-            block_q=min(block_size, Sq),
-            block_kv_compute=min(block_size, Sk),
-            block_kv=min(block_size, Sk),
-            block_q_dkv=min(block_size, Sq),
-            block_kv_dkv=min(block_size, Sk),
-            block_kv_dkv_compute=min(block_size, Sq),
-            block_q_dq=min(block_size, Sq),
-            block_kv_dq=min(block_size, Sq),
-        )
 
-        if mask.segment_ids is not None:
-            # for now only support self attention
-            segment_ids = segment_ids.array
-            segment_ids = SegmentIds(segment_ids, segment_ids)
+    attn_output = wrap_flash_attention(q_, k_, v_, segment_ids)
 
-        if mask is None:
-            base_mask = splash_attention_mask.FullMask(_shape=(Sq, Sk))
-        elif isinstance(mask, AttentionMask):
-            if mask.is_causal:
-                base_mask = splash_attention_mask.CausalMask(shape=(Sq, Sk))
-            else:
-                base_mask = splash_attention_mask.FullMask(_shape=(Sq, Sk))
-            # This is going to be a pain to support
-            if mask.explicit_mask is not None:
-                raise NotImplementedError("Explicit masks are not yet supported for splash attention")
+    attn_output = haliax.named(attn_output, ("B", "H", "S", "D"))
+    # the output shape is B, S_q, H_q, D_v. Right now we're requiring D_k == D_v
+    # we can reshape it to match our expected output
+    attn_output = _unflatten_bshd(attn_output, q_class, v_class)
+    # match the axis order and dtype simple_attention_with_dropout would produce. When q was already laid out as
+    # BHSD (as Attention does), the unflattened output is already in this order and we skip the transpose.
+    out_axes = _attention_output_axes(query.axes, key.axes, value.axes, KPos.name, axis_name(Key))
+    if attn_output.axes != out_axes:
+        attn_output = attn_output.rearrange(out_axes)
+    attn_output = attn_output.astype(query.dtype)
+
+    # no haliax.shard here: the shard_map's out_specs already place the output, and the caller's next op decides
+    # whatever layout it needs
+    return attn_output
 
-        elif isinstance(mask, NamedArray):
-            raise NotImplementedError("NamedArray masks are not yet supported for splash attention")
-        else:
-            raise ValueError(f"Unknown mask type: {mask}")
 
-        kernel_mask = splash_attention_mask.MultiHeadMask(masks=[base_mask for _ in range(Hq)])
+def _splash_attention_on_shard(
+    q,
+    k,
+    v,
+    segment_ids,
+    *,
+    block_size: int,
+    is_causal: bool,
+    logits_soft_cap: float | None,
+    is_mqa: bool,
+    scaling_factor: float,
+    segment_batch_axis: int | None,
+    interpret: bool = False,
+):
+    """
+    The per-device body of _tpu_splash_attention. This is a module-level function of only its (static) keyword
+    arguments rather than a closure, so that nothing but those values can leak into the traced computation.
+    """
+    # NB: inside the function, q, k, and v are partitioned, so in general the lengths of dims are not the same
+    Sq = q.shape[2]
+    Sk = k.shape[2]
+    Hq = q.shape[1]
+
+    if segment_ids is not None:
+        # for now only support self attention
+        segment_ids = segment_ids.array
+        segment_ids = SegmentIds(segment_ids, segment_ids)
+
+    splash_kernel = _make_splash_kernel(Sq, Sk, Hq, block_size, is_causal, logits_soft_cap, is_mqa, interpret)
+
+    if is_mqa:
+        k = k[:, 0]
+        v = v[:, 0]
+
+    # the kernel has no scale argument, so fold the scaling into whichever of q and k is smaller (k under GQA)
+    if k.size <= q.size:
+        k = k * jnp.asarray(scaling_factor, dtype=k.dtype)
+    else:
+        q = q * jnp.asarray(scaling_factor, dtype=q.dtype)
+
+    # The kernel only takes unbatched (H, S, D) inputs. vmapping a pallas_call adds the batch as an extra grid
+    # dimension of the same kernel, so this is already "kernel-native" batching.
+    return jax.vmap(
+        lambda q, k, v, si: splash_kernel(q, k, v, segment_ids=si), in_axes=(0, 0, 0, segment_batch_axis)
+    )(q, k, v, segment_ids)
+
+
+@functools.lru_cache(maxsize=32)
+def _make_splash_kernel(
+    Sq: int,
+    Sk: int,
+    Hq: int,
+    block_size: int,
+    is_causal: bool,
+    logits_soft_cap: float | None,
+    is_mqa: bool = False,
+    interpret: bool = False,
+):
+    """
+    Builds the splash attention kernel for the per-device shapes. The kernel (and its mask) only depends on these
+    static values, so it is built once and reused for every layer and step rather than on every trace.
+
+    We're usually called from inside a trace, so the mask info is built under `ensure_compile_time_eval`: the
+    cached kernel must hold concrete arrays, not tracers that would leak into the next trace that reuses it.
+    """
+    from jax.experimental.pallas.ops.tpu.splash_attention import splash_attention_kernel, splash_attention_mask
+
+    # The kernel skips kv blocks that are entirely masked, but still computes the partially masked blocks along the
+    # diagonal in full. For causal masks, narrower kv blocks halve that wasted work in the forward pass.
+    block_kv = block_size
+    if is_causal and block_size // 2 >= 128 and Sk % (block_size // 2) == 0:
+        block_kv = block_size // 2
+
+    block_sizes = splash_attention_kernel.BlockSizes(
+        block_q=min(block_size, Sq),
+        block_kv_compute=min(block_kv, Sk),
+        block_kv=min(block_kv, Sk),
+        block_q_dkv=min(block_size, Sq),
+        block_kv_dkv=min(block_size, Sk),
+        block_kv_dkv_compute=min(block_size, Sq),
+        block_q_dq=min(block_size, Sq),
+        block_kv_dq=min(block_size, Sq),
+    )
+
+    base_mask: splash_attention_mask.Mask
+    if is_causal:
+        base_mask = splash_attention_mask.CausalMask(shape=(Sq, Sk))
+    else:
+        base_mask = splash_attention_mask.FullMask(_shape=(Sq, Sk))
+
+    kernel_mask = splash_attention_mask.MultiHeadMask(masks=[base_mask for _ in range(Hq)])
 
-        # copied from MaxText
-        splash_kernel = splash_attention_kernel.make_splash_mha(
+    make_splash = splash_attention_kernel.make_splash_mqa if is_mqa else splash_attention_kernel.make_splash_mha
+
+    # copied from MaxText
+    with jax.ensure_compile_time_eval():
+        return make_splash(
             mask=kernel_mask,
             head_shards=1,
             q_seq_shards=1,
             block_sizes=block_sizes,
             attn_logits_soft_cap=logits_soft_cap,
+            interpret=interpret,
         )
 
-        q = q.astype(attention_dtype)
-        k = k.astype(attention_dtype)
-        v = v.astype(attention_dtype)
-        return jax.vmap(
-            lambda q, k, v, si: splash_kernel(q, k, v, segment_ids=si), in_axes=(0, 0, 0, segment_batch_axis)
-        )(q, k, v, segment_ids)
 
-    attn_output = wrap_flash_attention(q_, k_, v_, segment_ids)
-
-    attn_output = haliax.named(attn_output, ("B", "H", "S", "D"))
-    # the output shape is B, S_q, H_q, D_v. Right now we're requiring D_k == D_v
-    # we can reshape it to match our expected output
-    attn_output = _unflatten_bshd(attn_output, q_class, v_class)
-    with haliax.axis_mapping({}):
-        reference_out_shape = eqx.filter_eval_shape(
-            simple_attention_with_dropout,
-            QPos,
-            KPos,
-            Key,
-            query,
-            key,
-            value,
-            mask,
-            bias,
-            inference,
-            dropout,
-            attention_dtype,
-            precision,
-            prng=prng,
-        )
-    attn_output = attn_output.rearrange(reference_out_shape.axes).astype(reference_out_shape.dtype)
-
-    attn_output = haliax.shard(attn_output)
-
-    return attn_output
+_BACKEND_IMPLS: dict[AttentionBackend, Callable[..., Optional[NamedArray]]] = {
+    AttentionBackend.NVTE: _te_backend,
+    AttentionBackend.SPLASH: _splash_backend,
+    AttentionBackend.JAX_FLASH: _jax_flash_backend,
+    AttentionBackend.VANILLA: _vanilla_backend,
+}
 
 
 @dataclass(frozen=True)
@@ -1069,6 +1292,8 @@ class AttentionConfig:
         rope: Configuration for rotary position embeddings
         scaling_factor: Optional scaling factor for attention scores. If None, defaults to 1/sqrt(head_size)
         qk_norm: Optional configuration for QK normalization. If None, no normalization is applied.
+        attention_qkv_dtype: Optional dtype (e.g. "bfloat16") that q, k, and v are cast to before the attention
+            kernel. Overrides upcast_attn. Attention is memory-bound, so a narrower dtype here cuts HBM traffic.
     """
 
     Embed: Axis
@@ -1085,6 +1310,7 @@ class AttentionConfig:
     logits_soft_cap: Optional[float] = None
     qk_norm: Optional[LayerNormConfigBase] = None
     """Configuration for QK normalization. If None, no normalization is applied."""
+    attention_qkv_dtype: Optional[str] = None
 
     def __post_init__(self):
         assert (
@@ -1178,12 +1404,14 @@ class Attention(eqx.Module):
     def __call__(
         self, x: NamedArray, mask: Optional[NamedArray | AttentionMask], *, key=None, pos_ids: NamedArray | None = None
     ) -> NamedArray:
-        key_q, key_k, key_v, key_o = maybe_rng_split(key, 4)
+        # nothing in here is stochastic yet (the Linears ignore their keys and dropout is 0), so don't spend a
+        # threefry per layer splitting a key nobody reads
+        del key
 
         # Project to query, key, value
-        q_proj = self.q_proj(x, key=key_q)
-        k_proj = self.k_proj(x, key=key_k)
-        v = self.v_proj(x, key=key_v)
+        q_proj = self.q_proj(x)
+        k_proj = self.k_proj(x)
+        v = self.v_proj(x)
 
         # Apply QK normalization if enabled
         if self.config.qk_norm is not None:
@@ -1202,8 +1430,10 @@ class Attention(eqx.Module):
         if self.rot_embs is not None:
             if pos_ids is None:
                 pos_ids = hax.arange(x.resolve_axis("position"), dtype=jnp.int32)
-            q = self.rot_embs(q, pos_ids)
-            k = self.rot_embs(k, pos_ids)
+            # share one cos/sin table between q and k
+            cos, sin = self.rot_embs.cos_sin(pos_ids)
+            q = self.rot_embs.apply_cos_sin(q, cos, sin)
+            k = self.rot_embs.apply_cos_sin(k, cos, sin)
 
         # Rename position axis for attention
         k = k.rename({"position": "key_position"})
@@ -1218,19 +1448,41 @@ class Attention(eqx.Module):
             k,
             v,
             mask,
-            attention_dtype=jnp.float32 if self.config.upcast_attn else x.dtype,
+            attention_dtype=self._attention_dtype(x),
             attn_backend=self.config.attn_backend,
             flash_block_size=self.config.flash_attention_block_size,
             scaling_factor=self.config.scaling_factor,
             logits_soft_cap=self.config.logits_soft_cap,
             dropout=0.0,  # TODO: support dropout
             inference=True,  # TODO: support training
-            prng=key,
         )
 
-        # Flatten heads and apply output projection
-        attn_output = attn_output.flatten_axes(("kv_heads", "q_heads_per_group"), "heads")
+        # a no-op unless upcast_attn (or attention_qkv_dtype) changed the dtype
         attn_output = attn_output.astype(x.dtype)
-        attn_output = self.o_proj(attn_output, key=key_o)
+        attn_output = self._output_projection(attn_output)
 
         return attn_output
+
+    def _output_projection(self, attn_output: NamedArray) -> NamedArray:
+        o_proj = self.o_proj
+        if type(o_proj) is not hnn.Linear:
+            # e.g. LoRA: let the module do its thing on the flattened heads
+            return o_proj(attn_output.flatten_axes(("kv_heads", "q_heads_per_group"), "heads"))
+
+        # contract against a (kv_heads, q_heads_per_group) view of the weight instead, so that the attention output
+        # never has to be flattened. The weight keeps its checkpoint layout.
+        config = self.config
+        weight = o_proj.weight.unflatten_axis(config.Heads.name, (config.KVHeads, config.QHeadsPerGroup))
+        out = attn_output.dot(
+            weight, axis=(config.KVHeads, config.QHeadsPerGroup, config.HeadSize), dot_general=o_proj.dot_general
+        )
+        out = hax.auto_sharded(out)
+        if o_proj.bias is not None:
+            out = out + o_proj.bias
+            out = hax.auto_sharded(out)
+        return out
+
+    def _attention_dtype(self, x: NamedArray) -> jnp.dtype:
+        if self.config.attention_qkv_dtype is not None:
+            return jnp.dtype(self.config.attention_qkv_dtype)
+        return jnp.float32 if self.config.upcast_attn else x.dtype
@@ -21,14 +21,26 @@ def _rotate_half(x: NamedArray, HeadSize: Axis) -> NamedArray:
 
 class RotaryEmbeddings(eqx.Module):
     def __call__(self, q: NamedArray, position_ids: NamedArray) -> NamedArray:
+        cos, sin = self.cos_sin(position_ids)
+        return self.apply_cos_sin(q, cos, sin)
+
+    def cos_sin(self, position_ids: NamedArray) -> Tuple[NamedArray, NamedArray]:
+        """
+        The cos and sin tables for these positions. Compute these once and use `apply_cos_sin` to share them
+        between queries and keys.
+        """
         raise NotImplementedError("This is an abstract base class for RotaryEmbeddings. Use a subclass instead.")
 
+    def apply_cos_sin(self, q: NamedArray, cos: NamedArray, sin: NamedArray) -> NamedArray:
+        HeadDim = self.HeadDim  # type: ignore[attr-defined]
+        return q * cos + _rotate_half(q, HeadDim) * sin
+
 
 class DefaultRotaryEmbeddings(RotaryEmbeddings):
     HeadDim: Axis = eqx.field(static=True)
     config: "DefaultRotaryEmbeddingsConfig" = eqx.field(static=True)
 
-    def __call__(self, q: NamedArray, position_ids: NamedArray) -> NamedArray:
+    def cos_sin(self, position_ids: NamedArray) -> Tuple[NamedArray, NamedArray]:
         with jax.ensure_compile_time_eval():
             HeadHalfSize = self.HeadDim.resize(self.HeadDim.size // 2)
             inv_freq: NamedArray = 1.0 / (self.config.theta ** (hax.arange(HeadHalfSize, step=2) / self.HeadDim.size))
@@ -36,11 +48,7 @@ class DefaultRotaryEmbeddings(RotaryEmbeddings):
 
         freqs = inv_freq.broadcast_axis(position_ids.axes) * position_ids
         emb = hax.concatenate(self.HeadDim, (freqs, freqs))
-        cos = hax.cos(emb)
-        sin = hax.sin(emb)
-
-        q_embed = q * cos + _rotate_half(q, self.HeadDim) * sin
-        return q_embed
+        return hax.cos(emb), hax.sin(emb)
 
 
 @dataclass(frozen=True)
@@ -95,15 +103,11 @@ class Llama3RotaryEmbeddings(RotaryEmbeddings):
     HeadDim: Axis = eqx.field(static=True)
     config: "Llama3RotaryEmbeddingsConfig" = eqx.field(static=True)
 
-    def __call__(self, q: NamedArray, position_ids: NamedArray) -> NamedArray:
+    def cos_sin(self, position_ids: NamedArray) -> Tuple[NamedArray, NamedArray]:
         inv_freq_llama = self._compute_inv_freq_llama()
         freqs = position_ids * inv_freq_llama.broadcast_axis(position_ids.axes)
         emb = hax.concatenate(self.HeadDim, (freqs, freqs))
-        cos = hax.cos(emb)
-        sin = hax.sin(emb)
-
-        q_embed = q * cos + _rotate_half(q, self.HeadDim) * sin
-        return q_embed
+        return hax.cos(emb), hax.sin(emb)
 
     @staticmethod
     def init(HeadDim, config):
@@ -184,7 +188,7 @@ class YarnRotaryEmbeddings(RotaryEmbeddings):
     HeadDim: Axis = eqx.field(static=True)
     config: "YarnRotaryEmbeddingsConfig" = eqx.field(static=True)
 
-    def __call__(self, q: NamedArray, position_ids: NamedArray) -> NamedArray:
+    def cos_sin(self, position_ids: NamedArray) -> Tuple[NamedArray, NamedArray]:
         import math
 
         with jax.ensure_compile_time_eval():
@@ -219,11 +223,7 @@ class YarnRotaryEmbeddings(RotaryEmbeddings):
         else:
             temperature = math.sqrt(0.1 * self.config.mscale * math.log(self.config.factor) + 1.0)
 
-        cos = hax.cos(emb) * temperature
-        sin = hax.sin(emb) * temperature
-
-        q_embed = q * cos + _rotate_half(q, self.HeadDim) * sin
-        return q_embed
+        return hax.cos(emb) * temperature, hax.sin(emb) * temperature
 
     @staticmethod
     def init(HeadDim, config):
@@ -14,11 +14,11 @@ from haliax.partitioning import round_axis_for_partitioning
 import levanter
 from levanter.checkpoint import load_checkpoint
 from levanter.compat.hf_checkpoints import HFCheckpointConverter, RepoRef
-from levanter.data import DataLoader
+from levanter.data import AsyncDataset, DataLoader
 from levanter.data.text import LMMixtureDatasetConfig, SingleDatasetLMConfigBase
 from levanter.eval import TaggedEvaluator, eval_model
 from levanter.models.llama import LlamaConfig
-from levanter.models.lm_model import LmConfig, LmExample, LmHeadModel, compute_next_token_loss
+from levanter.models.lm_model import LmConfig, LmExample, LmHeadModel
 from levanter.trainer import TrainerConfig
 from levanter.utils.jax_utils import use_cpu_device
 from levanter.utils.tree_utils import inference_mode
@@ -42,6 +42,10 @@ class EvalLmConfig:
     log_top2_gap: bool = False
     log_param_stats: bool = False
 
+    mp: Optional[jmp.Policy] = None
+    """Mixed precision policy for evaluation, e.g. "p=bfloat16,c=bfloat16". Defaults to trainer.mp. Eval doesn't need
+    gradient precision, so a bf16 policy halves the bytes moved by every matmul."""
+
 
 def main(config: EvalLmConfig):
     levanter.initialize(config)
@@ -66,6 +70,17 @@ def main(config: EvalLmConfig):
     else:
         max_examples = None
 
+    analysis_sets: dict[str, AsyncDataset] = {}
+    if config.log_entropy or config.log_top2_gap:
+        if config.eval_on_train:
+            analysis_sets = dict(config.data.validation_sets(Pos))
+            if max_examples is not None:
+                analysis_sets = {name: ds.take(max_examples) for name, ds in analysis_sets.items()}
+        else:
+            # tagged_eval_sets tags each validation set with its name last, so reuse those (already truncated) sets
+            # rather than building the validation caches a second time
+            analysis_sets = {tags[-1]: ds for ds, tags in datasets}
+
     compute_axis_mapping = config.trainer.compute_axis_mapping
     parameter_axis_mapping = config.trainer.parameter_axis_mapping
 
@@ -74,34 +89,32 @@ def main(config: EvalLmConfig):
     if config.checkpoint_path is not None and config.hf_checkpoint is not None:
         raise ValueError("Must specify either checkpoint_path or hf_checkpoint, not both")
 
+    mp: jmp.Policy = config.mp if config.mp is not None else config.trainer.mp
+
+    key = jax.random.PRNGKey(0)
+    vocab_size = len(tokenizer)
+
     with config.trainer.device_mesh, hax.axis_mapping(parameter_axis_mapping):
         evaluator = TaggedEvaluator(
-            Batch, datasets, tokenizer, max_examples_per_dataset=max_examples, axis_mapping=compute_axis_mapping
+            Batch,
+            datasets,
+            tokenizer,
+            max_examples_per_dataset=max_examples,
+            axis_mapping=compute_axis_mapping,
         )
 
-        key = jax.random.PRNGKey(0)
-
-        vocab_size = len(tokenizer)
+        # the mesh is needed to know how far to pad the vocab
         Vocab = round_axis_for_partitioning(Axis("vocab", vocab_size), compute_axis_mapping)
         if vocab_size != Vocab.size:
             logger.info(f"Rounding vocab size from {vocab_size} to {Vocab.size} for partitioning")
 
-        mp: jmp.Policy = config.trainer.mp
-
-        @hax.named_jit
-        def compute_loss(model: LmHeadModel, example: LmExample):
-            with hax.axis_mapping(compute_axis_mapping):
-                model = inference_mode(model, True)
-                model = mp.cast_to_compute(model)
-                return compute_next_token_loss(model, example, key=None)
-
-        def compute_logits(model: LmHeadModel, example: LmExample):
-            model = mp.cast_to_compute(model)
-            with hax.axis_mapping(compute_axis_mapping):
-                activations = model.activations(example.tokens, key=None, attn_mask=example.attn_mask)
-                head = model.get_lm_head()
-                logits = hax.dot(activations, head, axis=model.Embed)
-                return logits
+        def compute_entropy_and_top2_gap(model: LmHeadModel, example: LmExample):
+            activations = model.activations(example.tokens, key=None, attn_mask=example.attn_mask)
+            head = model.get_lm_head()
+            # with a cross entropy block size, go through the vocab in blocks rather than materializing the logits
+            return levanter.analysis.entropy_and_top2_gap_from_embeddings(
+                activations, head, model.Embed, model.Vocab, block_size=model.config.cross_entropy_block_size
+            )
 
         # initialize the model
         if config.checkpoint_path is not None:
@@ -126,59 +139,48 @@ def main(config: EvalLmConfig):
         else:
             assert False, "Should not get here"
 
+        if config.log_param_stats:
+            # done first so that the stats describe the params as stored, not as cast for compute
+            logger.info("Computing param stats...")
+            log_dict = haliax.named_jit(levanter.analysis.summary_statistics_for_tree)(
+                "params", model, split_scan_layers=True, include_histogram=True
+            )
+
+            levanter.tracker.log(log_dict, step=0)
+
+        # Put the model in inference mode and cast it to the compute dtype once, rather than inside every jitted step.
+        # The stored params are donated so that we don't keep both copies of the model around for the rest of eval.
+        model = inference_mode(model, True)
+        model = hax.named_jit(mp.cast_to_compute, axis_resources=parameter_axis_mapping, donate_args=(True,))(model)
+
         log_dict = eval_model(evaluator, model, prefix="eval")
 
         levanter.tracker.log(log_dict, step=0)
 
         print("Loss:", log_dict["eval/loss"])
 
-        if config.log_entropy:
-            logger.info("Computing entropy...")
-            for name, dataset in config.data.validation_sets(Pos).items():
-                if config.trainer.max_eval_batches is not None:
-                    dataset = dataset.take(config.trainer.max_eval_batches * config.trainer.eval_batch_size)
-                loader = DataLoader(dataset, batch_size=config.trainer.eval_batch_size)
-                entropy_hist = levanter.analysis.compute_entropy_histogram(
-                    model,
-                    Vocab,
-                    compute_logits,
-                    loader,
-                )
-
-                levanter.tracker.log(
-                    {
-                        f"analysis/{name}/entropy": entropy_hist,
-                    },
-                    step=0,
-                )
-
-        if config.log_top2_gap:
-            logger.info("Computing top2_gap...")
-            for name, dataset in config.data.validation_sets(Pos).items():
-                if config.trainer.max_eval_batches is not None:
-                    dataset = dataset.take(config.trainer.max_eval_batches * config.trainer.eval_batch_size)
-                    loader = DataLoader(dataset, batch_size=config.trainer.eval_batch_size)
-                    top2_gap_hist = levanter.analysis.compute_top2_gap_histogram(
+        if analysis_sets:
+            # both come from the same logits, so compute them in one pass over the data
+            logger.info("Computing entropy and top2_gap...")
+
+            # this is all compute, so enter the compute mapping once here rather than in every traced call
+            with hax.axis_mapping(compute_axis_mapping):
+                for name, dataset in analysis_sets.items():
+                    # no padding: padded examples would show up as real tokens in the histograms
+                    loader = DataLoader(dataset, batch_size=config.trainer.eval_batch_size, pad_final_batch=False)
+                    entropy_hist, top2_gap_hist = levanter.analysis.compute_entropy_and_top2_gap_histograms(
                         model,
-                        Vocab,
-                        compute_logits,
+                        compute_entropy_and_top2_gap,
                         loader,
                     )
 
-                    levanter.tracker.log(
-                        {
-                            f"analysis/{name}/top2_gap": top2_gap_hist,
-                        },
-                        step=0,
-                    )
+                    to_log = {}
+                    if config.log_entropy:
+                        to_log[f"analysis/{name}/entropy"] = entropy_hist
+                    if config.log_top2_gap:
+                        to_log[f"analysis/{name}/top2_gap"] = top2_gap_hist
 
-        if config.log_param_stats:
-            logger.info("Computing param stats...")
-            log_dict = haliax.named_jit(levanter.analysis.summary_statistics_for_tree)(
-                "params", model, split_scan_layers=True, include_histogram=True
-            )
-
-            levanter.tracker.log(log_dict, step=0)
+                    levanter.tracker.log(to_log, step=0)
 
     # ray tasks don't reliably wait for the subprocesses to finish, so we need to manually finish the tracker
     levanter.tracker.current_tracker().finish()
@@ -228,6 +228,7 @@ class GemmaConfig(HFCompatConfig):
             num_kv_heads=self.num_kv_heads,
             use_bias=self.use_bias,
             upcast_attn=self.upcast_attn,
+            attention_qkv_dtype=self.attention_qkv_dtype,
             attn_backend=self.attn_backend,
             flash_attention_block_size=self.flash_attention_block_size,
             rope=self.rope,
@@ -572,6 +573,7 @@ class Gemma2Config(GemmaConfig):
             num_kv_heads=self.num_kv_heads,
             use_bias=self.use_bias,
             upcast_attn=self.upcast_attn,
+            attention_qkv_dtype=self.attention_qkv_dtype,
             attn_backend=self.attn_backend,
             flash_attention_block_size=self.flash_attention_block_size,
             rope=self.rope,
@@ -901,6 +903,7 @@ class Gemma3Config(Gemma2Config):
             num_kv_heads=self.num_kv_heads,
             use_bias=self.use_bias,
             upcast_attn=self.upcast_attn,
+            attention_qkv_dtype=self.attention_qkv_dtype,
             attn_backend=self.attn_backend,
             flash_attention_block_size=self.flash_attention_block_size,
             rope=self.rope,
@@ -221,6 +221,7 @@ class LlamaConfig(HFCompatConfig):
             head_dim=self.head_dim,
             use_bias=self.use_bias,
             upcast_attn=self.upcast_attn,
+            attention_qkv_dtype=self.attention_qkv_dtype,
             attn_backend=self.attn_backend,
             flash_attention_block_size=self.flash_attention_block_size,
             rope=self.rope,
@@ -135,6 +135,12 @@ class LmConfig(draccus.PluginRegistry, abc.ABC, Generic[LmT], discover_packages_
     value because it usually faster to compute the loss in larger blocks.
     """
 
+    attention_qkv_dtype: Optional[str] = None
+    """
+    The dtype (e.g. "bfloat16") q, k and v are cast to before they are handed to the attention backend. If None,
+    falls back to float32 when `upcast_attn` is set and to the activation dtype otherwise.
+    """
+
     def flops_per_token(self, vocab_size: int) -> Optional[float]:
         return None
 
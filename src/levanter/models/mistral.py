@@ -163,6 +163,7 @@ class MistralConfig(LlamaConfig):
             num_kv_heads=self.num_kv_heads,
             use_bias=self.use_bias,
             upcast_attn=self.upcast_attn,
+            attention_qkv_dtype=self.attention_qkv_dtype,
             attn_backend=self.attn_backend,
             flash_attention_block_size=self.flash_attention_block_size,
             rope=self.rope,
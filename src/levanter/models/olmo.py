@@ -231,6 +231,7 @@ class Olmo2Config(HFCompatConfig):
             num_kv_heads=self.num_kv_heads,
             use_bias=self.attention_bias,
             upcast_attn=self.upcast_attn,
+            attention_qkv_dtype=self.attention_qkv_dtype,
             attn_backend=self.attn_backend,
             flash_attention_block_size=self.flash_attention_block_size,
             rope=self.rope,
@@ -340,8 +341,10 @@ class Olmo2Attention(ModuleWithStateDictSerialization, eqx.Module):
         if self.rot_embs is not None:
             if pos_ids is None:
                 pos_ids = hax.arange(x.resolve_axis("position"))
-            q = self.rot_embs(q, pos_ids)
-            k = self.rot_embs(k, pos_ids)
+            # share one cos/sin table between q and k
+            cos, sin = self.rot_embs.cos_sin(pos_ids)
+            q = self.rot_embs.apply_cos_sin(q, cos, sin)
+            k = self.rot_embs.apply_cos_sin(k, cos, sin)
 
         # Rename position axis for attention
         k = k.rename({"position": "key_position"})
@@ -349,6 +352,10 @@ class Olmo2Attention(ModuleWithStateDictSerialization, eqx.Module):
 
         # Apply attention
         c = self.config
+        if c.attention_qkv_dtype is not None:
+            attention_dtype = jnp.dtype(c.attention_qkv_dtype)
+        else:
+            attention_dtype = jnp.float32 if c.upcast_attn else x.dtype
         attn_output = dot_product_attention(
             "position",
             "key_position",
@@ -357,7 +364,7 @@ class Olmo2Attention(ModuleWithStateDictSerialization, eqx.Module):
             k,
             v,
             mask,
-            attention_dtype=jnp.float32 if self.config.upcast_attn else x.dtype,
+            attention_dtype=attention_dtype,
             use_flash=c.use_flash_attention,
             attn_backend=self.config.attn_backend,
             flash_block_size=c.flash_attention_block_size,
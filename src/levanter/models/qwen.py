@@ -128,6 +128,7 @@ class QwenConfig(LlamaConfig):
             # qwen2 always uses bias in attention
             use_bias=True,
             upcast_attn=self.upcast_attn,
+            attention_qkv_dtype=self.attention_qkv_dtype,
             attn_backend=self.attn_backend,
             flash_attention_block_size=self.flash_attention_block_size,
             rope=self.rope,
@@ -1,4 +1,5 @@
 import functools
+from typing import Sequence
 
 import equinox
 import jax
@@ -50,6 +51,26 @@ class Histogram(equinox.Module):
         counts, edges = sharded_histogram(array, bins=num_bins)
         return Histogram(min, max, num, sum, sum_squares, edges, counts)
 
+    @staticmethod
+    def from_named_arrays(arrays: Sequence[hax.NamedArray], num_bins: int = 31) -> "Histogram":
+        """
+        As [from_named_array][], but for the concatenation of several arrays, which needn't have the same axes.
+        The arrays are never actually concatenated: each one is histogrammed where it lives (see
+        [sharded_histogram][]) and only the counts are summed.
+        """
+        if not arrays:
+            raise ValueError("Need at least one array")
+
+        raw_arrays = [a.array for a in arrays]
+        min = functools.reduce(jnp.minimum, [a.min() for a in raw_arrays])
+        max = functools.reduce(jnp.maximum, [a.max() for a in raw_arrays])
+        num = sum(a.size for a in arrays)
+        total = functools.reduce(jnp.add, [a.sum() for a in raw_arrays])
+        sum_squares = functools.reduce(jnp.add, [(a**2).sum() for a in raw_arrays])
+        edges = jnp.histogram_bin_edges(jnp.stack([min, max]), bins=num_bins)
+        counts = functools.reduce(jnp.add, [_shardmap_histogram(a, edges) for a in arrays])
+        return Histogram(min, max, num, total, sum_squares, edges, counts)
+
     def to_numpy_histogram(self) -> tuple[np.ndarray, np.ndarray]:
         return np.array(self.bucket_counts), np.array(self.bucket_limits)
 
@@ -101,8 +122,12 @@ def _single_shard_histogram(a, bin_edges, reduce_mesh):
     left_edges = bin_edges[:-1, None]  # shape: (N, 1)
     right_edges = bin_edges[1:, None]  # shape: (N, 1)
 
+    # as in jnp.histogram, the last bin also includes its right edge
+    is_last_bin = (jnp.arange(left_edges.shape[0]) == left_edges.shape[0] - 1)[:, None]
+    below_right = jnp.where(is_last_bin, a_exp <= right_edges, a_exp < right_edges)
+
     # now bin_idx will be shape (N, D)
-    bin_idx = ((a_exp >= left_edges) & (a_exp < right_edges)).astype(dtype)
+    bin_idx = ((a_exp >= left_edges) & below_right).astype(dtype)
     counts = bin_idx.sum(axis=1, dtype=dtype)
 
     # bin_idx = jnp.searchsorted(bin_edges, a, side='right', method='compare_all')
@@ -119,6 +144,10 @@ def _single_shard_histogram(a, bin_edges, reduce_mesh):
 
 def _shardmap_histogram(a: NamedArray, bins):
     mesh = hax.partitioning._get_mesh()
+    if mesh.empty:
+        # nothing to shard over (e.g. on a single device without a mesh)
+        return _single_shard_histogram(a.array, bins, reduce_mesh=())
+
     spec = hax.partitioning.pspec_for_axis(a.axes)
     flattened_spec = _flattened_spec(spec)
     shard_h = shard_map(
@@ -130,12 +159,7 @@ def _shardmap_histogram(a: NamedArray, bins):
         ),
         check_rep=False,
     )
-    res = shard_h(a.array, bins)
-
-    # the filter misses the last bin, so we need to add it
-    if res.size >= 1:
-        res = res.at[-1].add(1)
-    return res
+    return shard_h(a.array, bins)
 
 
 def _flattened_spec(spec):
@@ -726,6 +726,9 @@ class TrainerConfig:
         default_factory=lambda: copy.deepcopy(DEFAULT_JAX_CONFIG)
     )  # config to pass to jax.config.update
     jax_compilation_cache_dir: Optional[str] = None
+    """If set, JAX's persistent compilation cache is stored here, so repeated runs with the same programs (e.g.
+    re-running eval_lm on a new checkpoint) load their compiled executables instead of recompiling them. Can be a
+    local path or a GCS bucket."""
 
     distributed: DistributedConfig = DistributedConfig()
     ray: RayConfig = field(default_factory=RayConfig)
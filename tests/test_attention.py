@@ -1,5 +1,7 @@
+import functools
 import math
 
+import equinox as eqx
 import jax
 import jax.numpy as jnp
 import jax.random as jrandom
@@ -11,14 +13,23 @@ from jax.sharding import Mesh, NamedSharding, PartitionSpec
 import haliax as hax
 from haliax import Axis
 
+import levanter.layers.attention
 from levanter.layers.attention import (
+    Attention,
     AttentionBackend,
+    AttentionConfig,
     AttentionMask,
+    _attention_output_axes,
     _bin_and_group_axes_by_function,
+    _fold_in_shard_index,
+    _make_splash_kernel,
+    _splash_attention_on_shard,
     _te_flash_attention,
     _tpu_splash_attention,
     dot_product_attention,
+    simple_attention_with_dropout,
 )
+from levanter.models.llama import LlamaConfig
 from test_utils import skip_if_module_missing
 
 
@@ -58,6 +69,37 @@ def test_causal_mask_slicing():
             assert mat_sliced.array[i, j] == mat_mask.array[7 + i, 24 + j]
 
 
+def test_attention_mask_kind_is_in_tree_structure():
+    # kernels dispatch on the kind of mask at trace time, so it must be part of the (static) pytree structure
+    pos = hax.Axis("pos", 16)
+    key_pos = pos.alias("key_pos")
+
+    masks = [
+        AttentionMask(is_causal=False),
+        AttentionMask.causal(),
+        AttentionMask.causal().with_segment_ids(hax.zeros(pos, dtype=jnp.int32)),
+        AttentionMask.explicit(hax.ones((pos, key_pos), dtype=bool)),
+    ]
+    structures = [jax.tree_util.tree_structure(mask) for mask in masks]
+
+    assert len(set(structures)) == len(masks)
+    assert structures[1] == jax.tree_util.tree_structure(AttentionMask.causal())
+
+
+def test_combining_masks_accepts_segment_ids_with_permuted_axes():
+    batch = hax.Axis("batch", 2)
+    pos = hax.Axis("pos", 8)
+    segment_ids = (hax.arange(pos) // 4 + hax.arange(batch).broadcast_axis(pos)).rearrange((batch, pos))
+
+    mask = AttentionMask.causal().with_segment_ids(segment_ids)
+    permuted = AttentionMask.causal().with_segment_ids(segment_ids.rearrange((pos, batch)))
+
+    combined = mask & permuted
+
+    assert combined.segment_ids is not None
+    assert hax.all(combined.segment_ids == segment_ids)
+
+
 def test_te_bin_and_group_axes_by_function():
     QPos = hax.Axis("QPos", 128)
     KPos = hax.Axis("KPos", 128)
@@ -71,27 +113,27 @@ def test_te_bin_and_group_axes_by_function():
     v = hax.zeros((B, KPos, H, D))
 
     q_c, k_c, v_c = _bin_and_group_axes_by_function(q, k, v, "QPos", "KPos", "D")
-    assert q_c["B"] == [B]
-    assert k_c["B"] == [B]
-    assert v_c["B"] == [B]
+    assert q_c.B == (B,)
+    assert k_c.B == (B,)
+    assert v_c.B == (B,)
 
-    assert q_c["S"] == [QPos]
-    assert k_c["S"] == [KPos]
-    assert v_c["S"] == [KPos]
+    assert q_c.S == (QPos,)
+    assert k_c.S == (KPos,)
+    assert v_c.S == (KPos,)
 
-    assert q_c["H"] == [H]
-    assert k_c["H"] == [H]
-    assert v_c["H"] == [H]
+    assert q_c.H == (H,)
+    assert k_c.H == (H,)
+    assert v_c.H == (H,)
 
-    assert q_c["D"] == [D]
-    assert k_c["D"] == [D]
-    assert v_c["D"] == [D]
+    assert q_c.D == (D,)
+    assert k_c.D == (D,)
+    assert v_c.D == (D,)
 
     gq = hax.zeros((B, QPos, H, G, D))
     q_c, k_c, v_c = _bin_and_group_axes_by_function(gq, k, v, "QPos", "KPos", "D")
-    assert q_c["H"] == [H, G]
-    assert k_c["H"] == [H]
-    assert v_c["H"] == [H]
+    assert q_c.H == (H, G)
+    assert k_c.H == (H,)
+    assert v_c.H == (H,)
 
     gk = hax.zeros((B, KPos, G, H, D))
     with pytest.raises(ValueError):
@@ -103,21 +145,21 @@ def test_te_bin_and_group_axes_by_function():
     for gk_axes in [(B, KPos, G, H, D), (B, KPos, G, H, D), (G, B, KPos, H, D)]:
         gk = hax.zeros(gk_axes)
         q_c, k_c, v_c = _bin_and_group_axes_by_function(gq, gk, gk, "QPos", "KPos", "D")
-        assert q_c["H"] == [H, G]
-        assert k_c["H"] == [H, G]
-        assert v_c["H"] == [H, G]
+        assert q_c.H == (H, G)
+        assert k_c.H == (H, G)
+        assert v_c.H == (H, G)
 
     # axes that come before QPos are treated as batch (if shared)
     gq = hax.zeros((G, B, QPos, H, D))
     for gk_axes in [(B, KPos, H, G, D), (B, KPos, G, H, D), (G, B, KPos, H, D)]:
         gk = hax.zeros(gk_axes)
         q_c, k_c, v_c = _bin_and_group_axes_by_function(gq, gk, gk, "QPos", "KPos", "D")
-        assert q_c["H"] == [H]
-        assert k_c["H"] == [H]
-        assert v_c["H"] == [H]
-        assert q_c["B"] == [G, B]
-        assert k_c["B"] == [G, B]
-        assert v_c["B"] == [G, B]
+        assert q_c.H == (H,)
+        assert k_c.H == (H,)
+        assert v_c.H == (H,)
+        assert q_c.B == (G, B)
+        assert k_c.B == (G, B)
+        assert v_c.B == (G, B)
 
 
 def test_mqa_te_bin_and_group_axes_by_function():
@@ -133,9 +175,9 @@ def test_mqa_te_bin_and_group_axes_by_function():
     v = hax.zeros((B, KPos, D))
 
     q_c, k_c, v_c = _bin_and_group_axes_by_function(gq, k, v, "QPos", "KPos", "D")
-    assert q_c["H"] == [G]
-    assert k_c["H"] == []
-    assert v_c["H"] == []
+    assert q_c.H == (G,)
+    assert k_c.H == ()
+    assert v_c.H == ()
 
     gk = hax.zeros((B, KPos, G, D))
     with pytest.raises(ValueError):
@@ -143,6 +185,39 @@ def test_mqa_te_bin_and_group_axes_by_function():
         _bin_and_group_axes_by_function(gq, gk, v, "QPos", "KPos", "D")
 
 
+def test_attention_output_axes_match_reference():
+    B = hax.Axis("B", 2)
+    QPos = hax.Axis("QPos", 16)
+    KPos = hax.Axis("KPos", 16)
+    D = hax.Axis("D", 8)
+    H = hax.Axis("H", 2)
+    G = hax.Axis("G", 3)
+
+    for q_axes, k_axes, v_axes in [
+        ((B, H, G, QPos, D), (B, H, KPos, D), (B, H, KPos, D)),
+        ((QPos, B, D, H), (H, D, KPos, B), (KPos, H, B, D)),
+        ((B, QPos, G, D), (B, KPos, D), (B, KPos, D)),
+    ]:
+        q, k, v = hax.zeros(q_axes), hax.zeros(k_axes), hax.zeros(v_axes)
+        reference = eqx.filter_eval_shape(simple_attention_with_dropout, "QPos", "KPos", "D", q, k, v)
+        assert _attention_output_axes(q.axes, k.axes, v.axes, "KPos", "D") == reference.axes
+
+
+def test_fold_in_shard_index_gives_each_shard_its_own_key():
+    prng = jrandom.PRNGKey(0)
+    spec = PartitionSpec("data", None, ("replica",), None)
+
+    # vmap with axis names stands in for the mesh axes of a shard_map
+    keys = jax.vmap(
+        jax.vmap(lambda _: _fold_in_shard_index(prng, spec), axis_name="replica"), axis_name="data"
+    )(jnp.zeros((2, 2)))
+    keys = keys.reshape(4, -1)
+
+    assert len({tuple(k.tolist()) for k in keys}) == 4
+    # an unsharded input keeps the caller's key
+    assert _fold_in_shard_index(prng, PartitionSpec(None, None)).tolist() == prng.tolist()
+
+
 @skip_if_module_missing("transformer_engine")
 @pytest.mark.parametrize("q_heads", [1, 2, 4])
 def test_llama_attention_uses_te(q_heads):
@@ -236,6 +311,68 @@ def test_tpu_splash_attention():
         assert_trees_all_close(hax_out.array, flash_out.array, atol=1e-3, rtol=1e-3)
 
 
+@pytest.mark.parametrize("kv_heads", [1, 2])
+def test_tpu_splash_attention_gqa(kv_heads):
+    if jax.default_backend() != "tpu":
+        pytest.skip("TPU only")
+
+    BLOCK_SIZE = 512
+
+    KVHeads = hax.Axis("KVHeads", kv_heads)
+    QHeadsPerGroup = hax.Axis("QHeadsPerGroup", 8 // kv_heads)
+    Key = hax.Axis("Key", 128)
+    QPos = hax.Axis("QPos", BLOCK_SIZE * 2)
+    KPos = hax.Axis("KPos", BLOCK_SIZE * 2)
+
+    q = hax.random.normal(jrandom.PRNGKey(0), (QPos, KVHeads, QHeadsPerGroup, Key)) * 0.02
+    k = hax.random.normal(jrandom.PRNGKey(1), (KPos, KVHeads, Key)) * 0.02
+    v = hax.random.normal(jrandom.PRNGKey(2), (KPos, KVHeads, Key)) * 0.02
+
+    mask = AttentionMask.causal()
+
+    with jax.sharding.Mesh(jax.devices(), ("dp",)):
+        flash_out = _tpu_splash_attention(
+            QPos,
+            KPos,
+            Key,
+            q,
+            k,
+            v,
+            inference=True,
+            mask=mask,
+            block_size=BLOCK_SIZE,
+            scaling_factor=1 / math.sqrt(Key.size),
+        )
+        ref_out = simple_attention_with_dropout(
+            QPos, KPos, Key, q, k, v, mask=mask, inference=True, scaling_factor=1 / math.sqrt(Key.size)
+        )
+        assert ref_out.axes == flash_out.axes
+        assert_trees_all_close(ref_out.array, flash_out.array, atol=1e-3, rtol=1e-3)
+
+
+def test_cached_splash_kernel_survives_a_second_trace():
+    # the kernel cache is shared across traces, so a kernel built under one jit must not capture its tracers
+    _make_splash_kernel.cache_clear()
+    q, k, v = (jrandom.normal(jrandom.PRNGKey(i), (1, 2, 256, 128)) * 0.02 for i in range(3))
+
+    attend = functools.partial(
+        _splash_attention_on_shard,
+        segment_ids=None,
+        block_size=128,
+        is_causal=True,
+        logits_soft_cap=None,
+        is_mqa=False,
+        scaling_factor=1.0,
+        segment_batch_axis=None,
+        interpret=True,
+    )
+
+    first = jax.jit(lambda q, k, v: attend(q, k, v))(q, k, v)
+    second = jax.jit(lambda q, k, v: attend(q, k, v) * 2)(q, k, v)
+
+    assert_trees_all_close(second, first * 2, atol=1e-6, rtol=1e-6)
+
+
 @pytest.mark.parametrize("impl", ["default", "jax_flash", "vanilla"])
 def test_segment_ids_are_respected(impl):
     # test that we can't attend to something outside of the range
@@ -276,3 +413,65 @@ def test_segment_ids_are_respected(impl):
     assert_trees_all_close(result.array[0:3, 1], 300.0, atol=1e-3, rtol=1e-3)
     # the rest should be 0
     assert_trees_all_close(result.array[3:, 1], 0.0, atol=1e-3, rtol=1e-3)
+
+
+@pytest.mark.parametrize("mask", [None, AttentionMask.causal()])
+def test_single_key_attention_short_circuit(mask):
+    Head = hax.Axis("Head", 2)
+    Key = hax.Axis("Key", 4)
+    QPos = hax.Axis("QPos", 3)
+    KPos = hax.Axis("KPos", 1)
+
+    q = hax.random.normal(jrandom.PRNGKey(0), (QPos, Head, Key))
+    k = hax.random.normal(jrandom.PRNGKey(1), (KPos, Head, Key))
+    v = hax.random.normal(jrandom.PRNGKey(2), (KPos, Head, Key))
+
+    out = dot_product_attention(QPos, KPos, Key, q, k, v, mask=mask)
+    ref = simple_attention_with_dropout(QPos, KPos, Key, q, k, v, mask=mask, inference=True)
+
+    assert out.axes == ref.axes
+    assert_trees_all_close(out.array, ref.array, atol=1e-6, rtol=1e-6)
+
+
+@pytest.mark.parametrize("use_bias", [False, True])
+def test_output_projection_matches_flattened_o_proj(use_bias):
+    Embed = hax.Axis("embed", 32)
+    config = AttentionConfig(Embed=Embed, num_heads=4, num_kv_heads=2, use_bias=use_bias)
+    attn = Attention.init(config, key=jrandom.PRNGKey(0))
+    attn_output = hax.random.normal(
+        jrandom.PRNGKey(1),
+        (hax.Axis("batch", 2), config.KVHeads, config.QHeadsPerGroup, hax.Axis("position", 16), config.HeadSize),
+    )
+
+    out = attn._output_projection(attn_output)
+    ref = attn.o_proj(attn_output.flatten_axes(("kv_heads", "q_heads_per_group"), "heads"))
+
+    assert out.axes == ref.axes
+    assert_trees_all_close(out.array, ref.array, atol=1e-5, rtol=1e-5)
+
+
+@pytest.mark.parametrize("attention_qkv_dtype", [None, "bfloat16"])
+def test_attention_qkv_dtype_reaches_the_backend(monkeypatch, attention_qkv_dtype):
+    config = LlamaConfig(
+        seq_len=16,
+        hidden_dim=32,
+        intermediate_dim=64,
+        num_heads=4,
+        num_kv_heads=2,
+        upcast_attn=True,
+        attention_qkv_dtype=attention_qkv_dtype,
+    )
+    attn = Attention.init(config.attention_config(), key=jrandom.PRNGKey(0))
+    x = hax.random.normal(jrandom.PRNGKey(1), (hax.Axis("batch", 2), config.Pos, config.Embed))
+
+    seen = []
+
+    def spy(*args, attention_dtype=None, **kwargs):
+        seen.append(attention_dtype)
+        return dot_product_attention(*args, attention_dtype=attention_dtype, **kwargs)
+
+    monkeypatch.setattr(levanter.layers.attention, "dot_product_attention", spy)
+    attn(x, AttentionMask.causal())
+
+    expected = jnp.float32 if attention_qkv_dtype is None else jnp.bfloat16
+    assert seen == [jnp.dtype(expected)]
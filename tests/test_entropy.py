@@ -0,0 +1,49 @@
+import jax
+import jax.numpy as jnp
+import pytest
+
+import haliax as hax
+
+from levanter.analysis.entropy import (
+    entropy_and_top2_gap_from_embeddings,
+    entropy_from_logits,
+    top2_gap_from_logits,
+)
+
+
+Batch = hax.Axis("batch", 4)
+Pos = hax.Axis("position", 8)
+Embed = hax.Axis("embed", 16)
+Vocab = hax.Axis("vocab", 50)
+
+
+def test_entropy_from_logits():
+    logits = hax.random.normal(jax.random.PRNGKey(0), (Batch, Pos, Vocab)) * 3
+
+    entropy = entropy_from_logits(logits, axis=Vocab)
+
+    log_probs = jax.nn.log_softmax(logits.array, axis=-1)
+    expected = -jnp.sum(jnp.exp(log_probs) * log_probs, axis=-1)
+    assert jnp.allclose(entropy.array, expected, atol=1e-5)
+
+
+def test_top2_gap_from_logits():
+    logits = hax.random.normal(jax.random.PRNGKey(0), (Batch, Pos, Vocab)) * 3
+
+    gap = top2_gap_from_logits(logits, axis=Vocab)
+
+    sorted_logits = jnp.sort(logits.array, axis=-1)
+    assert jnp.allclose(gap.array, sorted_logits[..., -1] - sorted_logits[..., -2])
+
+
+@pytest.mark.parametrize("block_size", [None, 1, 7, 10, 64])
+def test_blockwise_entropy_and_top2_gap_matches_logits(block_size):
+    embeddings = hax.random.normal(jax.random.PRNGKey(0), (Batch, Pos, Embed))
+    lm_head = hax.random.normal(jax.random.PRNGKey(1), (Embed, Vocab))
+    logits = hax.dot(embeddings, lm_head, axis=Embed)
+
+    entropy, gap = entropy_and_top2_gap_from_embeddings(embeddings, lm_head, Embed, Vocab, block_size=block_size)
+
+    assert entropy.axes == (Batch, Pos)
+    assert jnp.allclose(entropy.array, entropy_from_logits(logits, axis=Vocab).array, atol=1e-4)
+    assert jnp.allclose(gap.array, top2_gap_from_logits(logits, axis=Vocab).array, atol=1e-4)
@@ -73,3 +73,24 @@ def test_sharded_histogram_with_vmap():
 
     assert jax.numpy.allclose(hist, hist_normal)
     assert jax.numpy.allclose(bins, bins_normal)
+
+
+def test_histogram_from_named_arrays_matches_concatenation():
+    mesh = Mesh((jax.devices()), (ResourceAxis.DATA,))
+
+    Batch = hax.Axis("batch", 16)
+    Batch2 = hax.Axis("batch", 8)
+    Feature = hax.Axis("feature", 32)
+
+    with mesh, hax.axis_mapping({"batch": ResourceAxis.DATA}):
+        a = hax.shard(hax.random.normal(PRNGKey(0), (Batch, Feature)))
+        b = hax.shard(hax.random.normal(PRNGKey(1), (Batch2, Feature)) * 2)
+        hist = levanter.tracker.histogram.Histogram.from_named_arrays([a, b], num_bins=32)
+
+    concatenated = jax.numpy.concatenate([a.array.ravel(), b.array.ravel()])
+    hist_normal, bins_normal = jax.numpy.histogram(concatenated, bins=32)
+
+    assert jax.numpy.allclose(hist.bucket_counts, hist_normal)
+    assert jax.numpy.allclose(hist.bucket_limits, bins_normal)
+    assert hist.num == concatenated.size
+    assert jax.numpy.allclose(hist.sum, concatenated.sum(), rtol=1e-4)
@@ -0,0 +1,47 @@
+import pytest
+from ray.exceptions import ActorDiedError, NodeDiedError, RayTaskError
+
+import levanter.infra.ray_tpu as ray_tpu
+from levanter.infra.ray_tpu import TpuPreempted, TpuRunError
+
+
+@pytest.fixture(autouse=True)
+def not_preempted(monkeypatch):
+    # never ask the metadata server
+    monkeypatch.setattr(ray_tpu, "get_current_tpu_is_preempted", lambda: False)
+    monkeypatch.setattr(ray_tpu, "_last_preemption_check", None)
+
+
+def _wrapped(cause: Exception) -> RayTaskError:
+    return RayTaskError("f", "traceback", cause).as_instanceof_cause()
+
+
+@pytest.mark.parametrize("cause", [ActorDiedError(), NodeDiedError("node died")])
+def test_wrapped_node_and_actor_failures_are_preemptions(cause):
+    error = _wrapped(cause)
+    assert isinstance(error, RayTaskError)
+
+    assert isinstance(ray_tpu._handle_ray_error(error), TpuPreempted)
+
+
+def test_wrapped_application_error_is_a_failure():
+    assert isinstance(ray_tpu._handle_ray_error(_wrapped(ValueError("bad"))), TpuRunError)
+
+
+def test_timeout_in_the_cause_chain_is_a_preemption():
+    try:
+        try:
+            raise RuntimeError("request timed out")
+        except RuntimeError as inner:
+            raise ValueError("worker failed") from inner
+    except ValueError as outer:
+        cause = outer
+
+    assert isinstance(ray_tpu._handle_ray_error(_wrapped(cause)), TpuPreempted)
+
+
+def test_timeout_only_in_the_remote_traceback_is_a_preemption():
+    error = RayTaskError("f", "Traceback ...\nRuntimeError: request timed out", ValueError("worker failed"))
+
+    assert isinstance(ray_tpu._handle_ray_error(error), TpuPreempted)
+    assert isinstance(ray_tpu._handle_ray_error(error.as_instanceof_cause()), TpuPreempted)